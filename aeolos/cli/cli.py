@@ -1,11 +1,17 @@
+from dataclasses import replace
 from typing import Any, List, Optional
 from pathlib import Path
+from threading import Lock
 import json
+import sys
+import time
 
 import typer
 from typing_extensions import Annotated
 
 from ..context import AeolosContext
+from ..executor.base import decode_line, iter_lines, iter_raw_lines
+from ..storage.logs import LogShipper, iter_stored_logs
 
 
 class DuplicateConfigError(ValueError):
@@ -58,56 +64,238 @@ def cli(
 
 
 @app.command()
-def launch():
+def launch(
+    workers: Annotated[int, typer.Option("--workers", "-w", min=1)] = 4,
+    log_interval: Annotated[float, typer.Option(help="seconds")] = 30.0,
+    log_chunk_size: Annotated[str, typer.Option(help="e.g. 16M")] = "16M",
+    log_compression: Annotated[str, typer.Option(help="gzip, zstd or none")] = "gzip",
+):
     job = ctx.job
 
     with ctx.launch() as address:
         print(f"[executor] {address}")
 
-        ctx.storage.set_meta(job.id + "/__address__", address)
-        print(f"[job {job.id}] starting")
+        shipper = LogShipper(
+            ctx.storage,
+            ctx.executor,
+            job.id,
+            interval=log_interval,
+            chunk_size=parse_size(log_chunk_size),
+            compression=None if log_compression == "none" else log_compression,
+        )
+        with shipper.ship():
+            ctx.storage.set_job_meta(job.id, {"__address__": address})
+            print(f"[job {job.id}] starting")
+
+            plan = ctx.plan(job, ctx.storage.is_done_many(list(job)))
+            for name, action in plan.items():
+                print(f"[plan] {name}: {action}")
+
+            ctx.repository.prefetch(
+                [step for step in job if plan[step.name] == "run" and step.command]
+            )
+
+            running: set[str] = set()
+            lock = Lock()
+
+            def set_running(name: str, active: bool):
+                with lock:
+                    if active:
+                        running.add(name)
+                    else:
+                        running.discard(name)
+                    step_names = ",".join(sorted(running))
+                    ctx.storage.set_job_meta(job.id, {"__step__": step_names})
+
+            def run_step(step):
+                if plan[step.name] == "skip":
+                    return
+
+                set_running(step.name, True)
+                ctx.storage.set_step_state(step, "running")
+                start = time.monotonic()
+
+                try:
+                    if plan[step.name] == "pull":
+                        print(f"[step {step.name}] in storage")
+                        with ctx.executor.place(step, [], ctx.storage.pull):
+                            ctx.storage.pull(step)
+                    elif step.command:
+                        print(f"[step {step.name}] start")
+
+                        def pull_input(dep):
+                            print(f"[step {step.name}] pulling {dep.name}")
+                            ctx.storage.pull(dep)
+
+                        # hosts of executors with several hosts pull missing inputs
+                        inputs = ctx.get_inputs(job, step)
+                        with ctx.executor.place(step, inputs, pull_input):
+                            ctx.repository.run(step)
+                            ctx.storage.store(step)
+                    else:
+                        ctx.storage.mark_done(step)
+                except Exception:
+                    duration = time.monotonic() - start
+                    ctx.storage.set_step_state(step, "failed", duration)
+                    raise
+                finally:
+                    set_running(step.name, False)
+
+                ctx.storage.set_step_state(step, "done", time.monotonic() - start)
+                print(f"[step {step.name}] done")
+
+            ctx.storage.set_job_state(job.id, "running")
+            try:
+                ctx.schedule(job, run_step, max_workers=workers)
+            except Exception:
+                ctx.storage.set_job_state(job.id, "failed")
+                raise
+            ctx.storage.set_job_state(job.id, "done")
+
+            ctx.storage.set_job_meta(job.id, {"__step__": ""})
+            print(f"[job {job.id}] done")
+
+
+@app.command("list")
+def list_jobs(
+    state: Annotated[
+        Optional[str], typer.Option(help="running, done or failed")
+    ] = None,
+    since: Annotated[Optional[float], typer.Option(help="hours")] = None,
+):
+    """List the jobs indexed by the storage"""
+    try:
+        jobs = ctx.storage.list_jobs(
+            state=state,
+            since=None if since is None else time.time() - since * 3600,
+        )
+    except RuntimeError:
+        print("[list] listing jobs is not supported by the storage", file=sys.stderr)
+        raise typer.Exit(1)
+    for job in jobs:
+        updated = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["updated"]))
+        print(
+            f"{job['id']}\t{job['state']}\t{job['done']}/{job['steps']} steps\t"
+            f"{job['bytes'] / 1024**2:.1f} MB\t{updated}"
+        )
 
-        for step in ctx.job:
-            ctx.storage.set_meta(job.id + "/__step__", step.id)
 
-            if ctx.storage.is_done(step):
-                print(f"[step {step.id}] in storage")
-                ctx.storage.pull(step)
-            else:
-                print(f"[step {step.id}] start")
-                ctx.repository.run(step)
-                ctx.storage.store(step)
+@app.command()
+def status():
+    steps = list(ctx.job)
+    done = ctx.storage.is_done_many(steps)
+    states = {
+        step.name: "done" if step_done else "pending"
+        for step, step_done in zip(steps, done)
+    }
 
-            print(f"[step {step.id}] done")
+    print(json.dumps(states, indent=2))
 
-        ctx.storage.set_meta(job.id + "/__step__", "")
-        ctx.storage.set_meta(job.id + "/__logs__", "\n".join(ctx.executor.iter_logs()))
-        print(f"[job {job.id}] done")
 
+def get_address(job_id: str) -> str:
+    try:
+        return ctx.storage.get_job_meta(job_id, ["__address__"])["__address__"]
+    except KeyError:
+        raise KeyError(f"No executor address stored for job {job_id}")
 
-@app.command()
-def status():
-    steps = {}
-    for step in ctx.job:
-        if ctx.storage.is_done(step):
-            steps[step.id] = "done"
-        else:
-            steps[step.id] = "pending"
 
-    print(json.dumps(steps, indent=2))
+@app.command()
+def logs(
+    follow: Annotated[bool, typer.Option("--follow", "-f")] = False,
+    offset: Annotated[int, typer.Option(help="byte offset to start at")] = 0,
+    step: Annotated[
+        Optional[str], typer.Option(help="only the output of a step")
+    ] = None,
+    tail: Annotated[Optional[int], typer.Option(help="only the last lines")] = None,
+):
+    """
+    Print the log of a job, from the storage if it was shipped there and the job
+    is not running anymore, otherwise from the executor. Following always
+    streams from the executor.
+    """
+    if step is not None:
+        address = get_address(ctx.job.id)
+        with ctx.connect(address, storage=False, repository=False):
+            data = ctx.executor.read_step_logs(f"{ctx.job.id}/{step}")
+        lines = list(iter_lines([data]))
+        for msg in lines[-tail:] if tail else lines:
+            print(msg)
+        return
 
+    if not follow and ctx.job.id not in ctx.storage.get_running_jobs([ctx.job.id]):
+        try:
+            for msg in iter_lines(iter_stored_logs(ctx.storage, ctx.job.id, offset)):
+                print(msg)
+            return
+        except KeyError:
+            pass
 
-@app.command()
-def logs():
-    address = ctx.storage.get_meta(ctx.job.id + "/__address__")
+    address = get_address(ctx.job.id)
     with ctx.connect(address, storage=False, repository=False):
-        for msg in ctx.executor.iter_logs():
-            print(msg)
+        try:
+            chunks = ctx.executor.iter_log_chunks(follow=follow, offset=offset)
+            for line in iter_raw_lines(chunks):
+                print(decode_line(line), flush=True)
+                offset += len(line)
+        except KeyboardInterrupt:
+            print(f"[logs] resume with --offset {offset}", file=sys.stderr)
 
 
 @app.command()
 def terminate():
-    address = ctx.storage.get_meta(ctx.job.id + "/__address__")
+    address = get_address(ctx.job.id)
     with ctx.connect(address, storage=False, repository=False):
         print("[executor] connected")
         ctx.executor.terminate()
+
+
+@app.command()
+def sweep():
+    """Terminate the idle instances of the executor that exceeded their idle TTL"""
+    for instance_id in ctx.executor.sweep():
+        print(f"[sweep] terminated {instance_id}")
+
+
+SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size: str) -> int:
+    """Parse a size in bytes with an optional K, M, G or T suffix"""
+    size = size.strip().upper().removesuffix("B")
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+@app.command()
+def gc(
+    budget: Annotated[Optional[str], typer.Option(help="e.g. 500G")] = None,
+    max_age: Annotated[Optional[float], typer.Option(help="days")] = None,
+    keep: Annotated[
+        List[Path], typer.Option(help="config of another job to keep")
+    ] = [],
+    dry_run: bool = False,
+):
+    """
+    Delete stored results that do not belong to the configured job, the jobs of
+    the configs to keep or a running job, first the ones older than max-age, then
+    the least recently used until the budget is met. A config to keep overrides
+    the keys of the configuration, e.g. only the job under `config`.
+    """
+    steps = list(ctx.job)
+    for path in keep:
+        config = ctx.config | read_configs([path], [])
+        steps += list(replace(ctx, config=config).job)
+
+    deleted = ctx.storage.collect_garbage(
+        steps,
+        budget=None if budget is None else parse_size(budget),
+        max_age=None if max_age is None else max_age * 24 * 3600,
+        dry_run=dry_run,
+    )
+
+    for result in deleted:
+        print(f"[gc] {result['location']}: {result['size'] / 1024**2:.1f} MB")
+    size = sum(result["size"] for result in deleted) / 1024**2
+    action = "would delete" if dry_run else "deleted"
+    print(f"[gc] {action} {len(deleted)} results, {size:.1f} MB")
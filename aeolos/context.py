@@ -1,9 +1,10 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 from dataclasses import dataclass
 import json
-from typing import Any
+from typing import Any, Callable
 
-from aeolos import Stage, Task, Job, Executor, Storage, Repository
+from aeolos import Stage, Step, Task, Job, Executor, Storage, Repository
 from aeolos.utils import ConfigurableObject
 from aeolos.executor.executing import Executing
 
@@ -66,11 +67,105 @@ class AeolosContext:
     def launch(self):
         with self.executor.setup() as address:
             with self.connect(address):
+                self.executor.start()
                 try:
                     yield address
                 finally:
                     self.executor.cleanup()
 
+    def plan(self, job: Job, done: list[bool]) -> dict[str, str]:
+        """
+        Plan what to do with each step of a job, given which steps are done.
+        :return: The action per step name: "run" if the step is not done, "pull" if
+            it is done and its result is needed by a step that runs, otherwise "skip".
+            A step without command only collects the results of its dependencies, so
+            they are needed wherever it is needed. Nothing is stored for it, so it is
+            never pulled, but run, which only marks it done.
+        """
+        steps = {step.name: step for step in job}
+        actions = {
+            step.name: "skip" if step_done else "run"
+            for step, step_done in zip(steps.values(), done)
+        }
+
+        needed = [
+            dep
+            for step in steps.values()
+            if actions[step.name] == "run" and step.command
+            for dep in step.depends_on
+        ]
+        seen = set()
+        while needed:
+            name = needed.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+
+            if not steps[name].command:
+                actions[name] = "run"
+                needed += steps[name].depends_on
+            elif actions[name] == "skip":
+                actions[name] = "pull"
+
+        return actions
+
+    def get_inputs(self, job: Job, step: Step) -> list[Step]:
+        """
+        Get the steps whose results a step reads: its dependencies, and for
+        dependencies without command, which only collect results, theirs.
+        """
+        steps = {s.name: s for s in job}
+        inputs = []
+        needed = list(step.depends_on)
+        seen = set()
+        while needed:
+            name = needed.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+
+            if steps[name].command:
+                inputs.append(steps[name])
+            else:
+                needed += steps[name].depends_on
+
+        return inputs
+
+    def schedule(self, job: Job, run: Callable[[Step], None], max_workers: int = 1):
+        """
+        Run the steps of a job on a bounded worker pool.
+        A step is dispatched as soon as all steps it depends on are finished.
+        A failed step blocks the steps depending on it, while independent steps
+        keep running. The first error is raised once no more steps can run.
+        """
+        pending = {step.name: step for step in job}
+        running: dict[Future, str] = {}
+        done: set[str] = set()
+        error: Exception | None = None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while pending or running:
+                for name, step in list(pending.items()):
+                    if done.issuperset(step.depends_on):
+                        running[pool.submit(run, step)] = name
+                        del pending[name]
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                    except Exception as e:
+                        if error is None:
+                            error = e
+
+        if error is not None:
+            raise error
+
     def as_dict(self) -> dict[str, Any]:
         return {
             "executor": self.executor.as_dict(),
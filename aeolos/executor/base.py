@@ -1,15 +1,52 @@
 from abc import ABC, abstractmethod
 from contextlib import contextmanager
-from typing import Iterator
+from pathlib import Path
+from subprocess import CalledProcessError
+from threading import local
+from typing import Any, Callable, Iterable, Iterator
+import json
+import time
 
 from aeolos import Step
 from aeolos.utils import ConfigurableObject
 
+LOG_INDEX = "__log_index__.jsonl"
+"""Index of the log segments of the steps, one JSON entry per line"""
+LOG_SEGMENTS = "__steps__"
+
+
+# queued commands of the active batches, by thread and executor
+_batches = local()
+
 
 class NotConnectedError(Exception):
     pass
 
 
+def iter_raw_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Split a stream of byte chunks into lines, as soon as each line is complete.
+    The lines keep their line ends, so that their lengths add up to the stream.
+    """
+    buffer = b""
+    for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            yield line + b"\n"
+    if buffer:
+        yield buffer
+
+
+def decode_line(line: bytes) -> str:
+    return line.decode(errors="replace").rstrip("\n").rstrip("\r")
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Split a stream of byte chunks into decoded lines without line ends"""
+    for line in iter_raw_lines(chunks):
+        yield decode_line(line)
+
+
 class Executor(ABC, ConfigurableObject):
     @contextmanager
     def setup(self) -> Iterator[str]:
@@ -29,11 +66,36 @@ class Executor(ABC, ConfigurableObject):
         """Connect to the executor."""
         with self.setup() as address:
             with self.connect(address):
+                self.start()
                 try:
                     yield address
                 finally:
                     self.cleanup()
 
+    def start(self):
+        """
+        Start a launch on the executor.
+        Commands are available.
+        """
+        return
+
+    @contextmanager
+    def place(
+        self, step: Step, inputs: list[Step], pull: Callable[[Step], None]
+    ) -> Iterator[list[Step]]:
+        """
+        Run the commands dispatched in this thread on the host chosen for a step.
+        :param inputs: The steps whose results the step reads.
+        :param pull: Pulls the result of an input that is missing on the host.
+        :return: The inputs that were pulled.
+        """
+        yield []
+
+    @property
+    def host(self) -> str:
+        """Identifier of the host that runs the commands dispatched in this thread"""
+        return ""
+
     def cleanup(self):
         """
         Clean up the executor.
@@ -54,11 +116,137 @@ class Executor(ABC, ConfigurableObject):
         """
         ...
 
+    @contextmanager
+    def batch(self) -> Iterator[list[dict[str, Any]]]:
+        """
+        Queue the commands dispatched in this thread and run them with `run_batch`
+        on exit. Commands are deferred, so nothing in the batch may depend on the
+        effects of an earlier command. Nested batches join the outer batch.
+        :return: The results of the commands, filled on exit.
+        """
+        queues = getattr(_batches, "queues", None)
+        if queues is None:
+            queues = _batches.queues = {}
+
+        results: list[dict[str, Any]] = []
+        if id(self) in queues:
+            yield results
+            return
+
+        queues[id(self)] = []
+        try:
+            yield results
+            commands = queues[id(self)]
+        finally:
+            del queues[id(self)]
+
+        if commands:
+            results += self.run_batch(commands)
+        for result in results:
+            if "error" in result:
+                raise result["error"]
+
+    def dispatch(
+        self,
+        cmd: str | list[str],
+        env: dict[str, str] | None = None,
+        step: Step | None = None,
+    ):
+        """Run a command, or queue it if a batch is active in this thread"""
+        queue = getattr(_batches, "queues", {}).get(id(self))
+        if queue is None:
+            self.command(cmd, env=env, step=step)
+        else:
+            queue.append({"cmd": cmd, "env": env, "step": step})
+
+    def run_batch(self, commands: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """
+        Run several commands, stopping at the first failure.
+        :param commands: The `cmd`, `env` and `step` of each command.
+        :return: The `returncode`, `start` and `end` time of the commands that ran,
+            and the `error` of a failed command.
+        """
+        results = []
+        for command in commands:
+            result: dict[str, Any] = {"returncode": 0, "start": time.time()}
+            results.append(result)
+            try:
+                self.command(command["cmd"], env=command["env"], step=command["step"])
+            except CalledProcessError as e:
+                result |= {"returncode": e.returncode, "error": e}
+            result["end"] = time.time()
+            if "error" in result:
+                break
+        return results
+
+    def get_local_path(self, step: Step | None = None) -> Path | None:
+        """
+        Get the path of a workdir, if it is accessible from this process.
+        :return: The path of the step workdir or the executor workdir if no step is
+            given, or None if the workdir is not on this host.
+        """
+        return None
+
     @abstractmethod
-    def iter_logs(self, follow: bool = False) -> Iterator[str]:
-        """Get all log messages"""
+    def iter_log_chunks(self, follow: bool = False, offset: int = 0) -> Iterator[bytes]:
+        """
+        Get the log as chunks of bytes, starting at a byte offset of the log.
+        :param follow: Keep yielding new data as it is written, until the launch ends.
+        """
         ...
 
+    def iter_logs(self, follow: bool = False, offset: int = 0) -> Iterator[str]:
+        """
+        Get the log messages, starting at a byte offset of the log.
+        :param follow: Keep yielding new messages as they are written.
+        """
+        yield from iter_lines(self.iter_log_chunks(follow=follow, offset=offset))
+
+    def read_logs(self, offset: int = 0, limit: int | None = None) -> bytes:
+        """Read at most `limit` bytes of the log, starting at a byte offset"""
+        raise RuntimeError("Not supported")
+
+    def get_log_sources(self) -> list["Executor"]:
+        """Get the executors whose logs make up the log, to be read one by one"""
+        return [self]
+
+    def get_segment_name(self, step: Step) -> str:
+        """Get the path of the log segment of a step relative to the workdir"""
+        return f"{LOG_SEGMENTS}/{step.path}.log"
+
+    def read_file(self, name: str, offset: int = 0, limit: int | None = None) -> bytes:
+        """Read at most `limit` bytes of a file in the workdir, starting at an offset"""
+        raise RuntimeError("Not supported")
+
+    def get_log_index(self) -> list[dict[str, Any]]:
+        """
+        Get the index of the log segments.
+        Each command of a step appends an entry with the `step` path, the segment
+        `file`, the `offset` and `length` of its output and its `start` and `end`.
+        """
+        try:
+            data = self.read_file(LOG_INDEX)
+        except FileNotFoundError:
+            return []
+        return [json.loads(line) for line in data.decode().splitlines() if line]
+
+    def read_step_logs(self, step_path: str) -> bytes:
+        """Read the output of the commands of a step with one ranged read"""
+        entries = [e for e in self.get_log_index() if e["step"] == step_path]
+        if not entries:
+            raise KeyError(f"No logs of step {step_path}")
+
+        offset = min(e["offset"] for e in entries)
+        end = max(e["offset"] + e["length"] for e in entries)
+        return self.read_file(entries[0]["file"], offset, end - offset)
+
     def terminate(self):
         """Terminate the executor."""
         raise RuntimeError("Not supported")
+
+    def sweep(self) -> list[str]:
+        """
+        Terminate the idle resources of the executor that outlived their TTL.
+        :return: The IDs of the terminated resources.
+        """
+        raise RuntimeError("Not supported")
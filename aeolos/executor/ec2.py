@@ -1,13 +1,69 @@
-from contextlib import contextmanager
-from typing import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from queue import Queue
+from threading import Lock, Thread, local
+from typing import Callable, Iterator
 from fabric import Connection
+from secrets import token_hex
 import boto3
+import shlex
+import socket
+import time
 from typing import Any
 
+from aeolos import Executor, Step
+from .base import iter_raw_lines
 from .ssh import SSH
 
+POOL_TAG = "aeolos:pool"
+STATE_TAG = "aeolos:state"
+LEASE_TAG = "aeolos:lease"
+IDLE_SINCE_TAG = "aeolos:idle-since"
+IDLE_TTL_TAG = "aeolos:idle-ttl"
+
+
+def get_tags(instance) -> dict[str, str]:
+    return {tag["Key"]: tag["Value"] for tag in instance.tags or []}
+
+
+def get_ec2(
+    region: str | None = None,
+    access_key: str | None = None,
+    secret_key: str | None = None,
+):
+    return boto3.resource(
+        "ec2",
+        region_name=region,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+    )
+
+
+def wait_for_port(host: str, port: int = 22, timeout: float = 300.0):
+    """
+    Wait until a host accepts connections on a port.
+    :raises TimeoutError: If the port is not open within the timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=5):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{host}:{port} not reachable")
+            time.sleep(2)
+
 
 class EC2(SSH):
+    """
+    Runs a job on an EC2 instance, which is terminated at the end of the launch.
+    With `idle_ttl`, instances are kept in the idle pool `pool` for that many seconds
+    after a launch instead, and later launches with the same AMI and instance type
+    lease an idle instance before creating a new one. The state of an instance is
+    kept in its tags. Each launch runs in its own workdir on the instance.
+    """
+
     def __init__(
         self,
         ami_id: str,
@@ -20,6 +76,9 @@ class EC2(SSH):
         region: str | None = None,
         access_key: str | None = None,
         secret_key: str | None = None,
+        idle_ttl: float | None = None,
+        pool: str = "aeolos",
+        lease_delay: float = 2.0,
     ):
         super().__init__(
             uri="localhost",
@@ -34,23 +93,19 @@ class EC2(SSH):
         self.other_params = other_params
         self.user = user
         self.region = region
+        self.idle_ttl = idle_ttl
+        self.pool = pool
+        self.lease_delay = lease_delay
         self._access_key = access_key
         self._secret_key = secret_key
 
         self._connection: Connection | None = None
 
     def get_ec2(self):
-        return boto3.resource(
-            "ec2",
-            region_name=self.region,
-            aws_access_key_id=self._access_key,
-            aws_secret_access_key=self._secret_key,
-        )
+        return get_ec2(self.region, self._access_key, self._secret_key)
 
-    @contextmanager
-    def setup(self) -> Iterator[str]:
-        ec2 = self.get_ec2()
-        instance = ec2.create_instances(
+    def create_instance(self, ec2):
+        return ec2.create_instances(
             ImageId=self.ami_id,
             MinCount=1,
             MaxCount=1,
@@ -61,18 +116,429 @@ class EC2(SSH):
             ],
             **self.other_params,
         )[0]
+
+    def get_idle_instances(self, ec2, matching: bool = True) -> list:
+        """
+        Get the running idle instances of the pool.
+        :param matching: Only get the instances with the AMI and instance type.
+        """
+        filters = [
+            {"Name": f"tag:{POOL_TAG}", "Values": [self.pool]},
+            {"Name": f"tag:{STATE_TAG}", "Values": ["idle"]},
+            {"Name": "instance-state-name", "Values": ["running"]},
+        ]
+        if matching:
+            filters += [
+                {"Name": "image-id", "Values": [self.ami_id]},
+                {"Name": "instance-type", "Values": [self.instance_type]},
+            ]
+        return list(ec2.instances.filter(Filters=filters))
+
+    def get_idle_time(self, instance) -> tuple[float, float]:
+        """
+        Get how long an instance is idle and its idle TTL, which is set on release
+        by the launch that used it last.
+        """
+        tags = get_tags(instance)
+        idle_time = time.time() - float(tags.get(IDLE_SINCE_TAG, 0))
+        return idle_time, float(tags.get(IDLE_TTL_TAG, self.idle_ttl or 0))
+
+    def sweep(self) -> list[str]:
+        """
+        Terminate the idle instances of the pool that exceeded the idle TTL.
+        :return: The IDs of the terminated instances.
+        """
+        ec2 = self.get_ec2()
+        ids = []
+        for instance in self.get_idle_instances(ec2, matching=False):
+            idle_time, ttl = self.get_idle_time(instance)
+            if idle_time > ttl:
+                ids.append(instance.id)
+        if ids:
+            ec2.instances.filter(InstanceIds=ids).terminate()
+        return ids
+
+    def lease(self, ec2, token: str):
+        """
+        Lease an idle instance by tagging it as busy with a lease token.
+        Each instance is re-read right before, and only tagged if it is still idle
+        and not leased. Tags cannot be compared and set at once, so the lease is
+        only taken if the token is still set after `lease_delay` seconds, when
+        competing launches have overwritten it.
+        :return: The leased instance, or None if no idle instance could be leased.
+        """
+        for instance in self.get_idle_instances(ec2):
+            # skip instances leased since they were listed
+            instance.reload()
+            tags = get_tags(instance)
+            if tags.get(STATE_TAG) != "idle" or LEASE_TAG in tags:
+                continue
+
+            # leave a margin, so that a sweeper does not terminate a leased instance
+            idle_time, ttl = self.get_idle_time(instance)
+            if idle_time > ttl - min(60, ttl / 2):
+                continue
+
+            instance.create_tags(
+                Tags=[
+                    {"Key": STATE_TAG, "Value": "busy"},
+                    {"Key": LEASE_TAG, "Value": token},
+                ]
+            )
+            time.sleep(self.lease_delay)
+            instance.reload()
+            if get_tags(instance).get(LEASE_TAG) == token:
+                return instance
+        return None
+
+    def stop(self):
+        launched = self._launch_channel is not None
+        super().stop()
+        if launched and self.idle_ttl is not None:
+            # instances are reused, so the workdir of a launch is removed with it
+            self.ssh.run(f"rm -rf {shlex.quote(self.workdir)}", in_stream=False)
+
+    def release(self, instance, token: str):
+        """Return a leased instance to the idle pool"""
+        instance.reload()
+        if get_tags(instance).get(LEASE_TAG) != token:
+            return
+        instance.create_tags(
+            Tags=[
+                {"Key": STATE_TAG, "Value": "idle"},
+                {"Key": IDLE_SINCE_TAG, "Value": str(time.time())},
+                {"Key": IDLE_TTL_TAG, "Value": str(self.idle_ttl)},
+            ]
+        )
+        instance.delete_tags(Tags=[{"Key": LEASE_TAG}])
+
+    @contextmanager
+    def setup(self) -> Iterator[str]:
+        if self.idle_ttl is None:
+            with self.setup_instance() as address:
+                yield address
+            return
+
+        ec2 = self.get_ec2()
+        self.sweep()
+
+        token = token_hex(8)
+        instance = self.lease(ec2, token)
+        if instance is None:
+            instance = self.create_instance(ec2)
+            instance.create_tags(
+                Tags=[
+                    {"Key": POOL_TAG, "Value": self.pool},
+                    {"Key": STATE_TAG, "Value": "busy"},
+                    {"Key": LEASE_TAG, "Value": token},
+                ]
+            )
+
+        released = False
+        try:
+            instance.wait_until_running()
+            address = self.user + "@" + instance.public_dns_name
+            yield address + "/" + token_hex(4)
+
+            self.release(instance, token)
+            released = True
+        finally:
+            # the state of an instance is unknown after a failure
+            if not released:
+                instance.terminate()
+
+    @contextmanager
+    def setup_instance(self) -> Iterator[str]:
+        """Create an instance for one launch"""
+        instance = self.create_instance(self.get_ec2())
+        try:
+            instance.wait_until_running()
+            yield self.user + "@" + instance.public_dns_name
+        finally:
+            instance.terminate()
+
+
+class EC2Pool(Executor):
+    """
+    A pool of `count` EC2 instances, requested at once and waited for concurrently,
+    until they are running and accept SSH connections within `ssh_timeout` seconds.
+    The address of the pool joins the addresses of the instances with commas.
+    Each step is placed on the instance running the fewest steps, preferring the
+    instances that hold the results of its inputs, and the results missing on that
+    instance are pulled from the storage. Commands without a step outside of a
+    placement, e.g. image prefetches, run on every instance. The logs of all
+    instances make up the log of the pool.
+    """
+
+    def __init__(
+        self,
+        ami_id: str,
+        instance_type: str,
+        key_name: str,
+        key_file: str,
+        security_group: str,
+        count: int = 2,
+        other_params: dict[str, Any] = {},
+        user: str = "ubuntu",
+        region: str | None = None,
+        access_key: str | None = None,
+        secret_key: str | None = None,
+        ssh_timeout: float | None = 300.0,
+        sessions: int = 4,
+    ):
+        if count < 1:
+            raise ValueError("Pool must have at least one instance")
+
+        self.ami_id = ami_id
+        self.instance_type = instance_type
+        self.key_name = key_name
+        self.key_file = key_file
+        self.security_group = security_group
+        self.count = count
+        self.other_params = other_params
+        self.user = user
+        self.region = region
+        self.ssh_timeout = ssh_timeout
+        self.sessions = sessions
+        self._access_key = access_key
+        self._secret_key = secret_key
+
+        self._members: list[Executor] = []
+        self._placement = local()
+        self._running: list[int] = []
+        self._holders: dict[str, set[int]] = {}
+        self._pulls: dict[tuple[str, int], Future] = {}
+        self._placement_lock = Lock()
+
+    @property
+    def members(self) -> list[Executor]:
+        if not self._members:
+            raise RuntimeError("Not connected")
+        return self._members
+
+    def get_ec2(self):
+        return get_ec2(self.region, self._access_key, self._secret_key)
+
+    def wait_for_instance(self, instance) -> str:
+        """
+        Wait until an instance is running and reachable over SSH.
+        :return: The address of the instance.
+        """
         instance.wait_until_running()
-        address = self.user + "@" + instance.public_dns_name
-        yield address
+        instance.reload()
+        host = instance.public_dns_name
+        if self.ssh_timeout is not None:
+            wait_for_port(host, 22, self.ssh_timeout)
+        return self.user + "@" + host
+
+    @contextmanager
+    def setup(self) -> Iterator[str]:
+        ec2 = self.get_ec2()
+        instances = ec2.create_instances(
+            ImageId=self.ami_id,
+            MinCount=self.count,
+            MaxCount=self.count,
+            InstanceType=self.instance_type,
+            KeyName=self.key_name,
+            SecurityGroupIds=[
+                self.security_group,
+            ],
+            **self.other_params,
+        )
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(instances)) as pool:
+                addresses = list(pool.map(self.wait_for_instance, instances))
+            yield ",".join(addresses)
+        finally:
+            ids = [instance.id for instance in instances]
+            ec2.instances.filter(InstanceIds=ids).terminate()
 
-        instance.terminate()
+    def get_member(self, address: str) -> Executor:
+        """Get the executor of an instance of the pool"""
+        return SSH(uri=address, key_file=self.key_file, sessions=self.sessions)
 
     @contextmanager
     def connect(self, address: str):
-        with Connection(
-            host=address,
-            connect_kwargs={"key_filename": self.key_file},
-        ) as self._connection:
-            yield
+        addresses = address.split(",")
+        with ExitStack() as stack:
+            members = [self.get_member(a) for a in addresses]
+            for member, member_address in zip(members, addresses):
+                stack.enter_context(member.connect(member_address))
+
+            self._members = members
+            self._running = [0] * len(members)
+            try:
+                yield
+            finally:
+                self._members = []
+                self._holders = {}
+                self._pulls = {}
+
+    def start(self):
+        for member in self.members:
+            member.start()
+
+    def cleanup(self):
+        for member in self.members:
+            member.cleanup()
+
+    @contextmanager
+    def place(
+        self, step: Step, inputs: list[Step], pull: Callable[[Step], None]
+    ) -> Iterator[list[Step]]:
+        """
+        Place a step and pull its missing inputs. Inputs that another step is
+        pulling onto the same instance are waited for instead of pulled again.
+        """
+
+        def holds(i: int, s: Step) -> bool:
+            return i in self._holders.get(s.path, ()) or (s.path, i) in self._pulls
+
+        waits, pulls = [], []
+        with self._placement_lock:
+            index = min(
+                range(len(self.members)),
+                key=lambda i: (self._running[i], -sum(holds(i, s) for s in inputs)),
+            )
+            self._running[index] += 1
+            for s in inputs:
+                if index in self._holders.get(s.path, ()):
+                    continue
+                if (s.path, index) in self._pulls:
+                    waits.append(self._pulls[s.path, index])
+                else:
+                    pulls.append((s, self._pulls.setdefault((s.path, index), Future())))
+
+        self._placement.index = index
+        try:
+            try:
+                for s, future in pulls:
+                    pull(s)
+                    with self._placement_lock:
+                        self._holders.setdefault(s.path, set()).add(index)
+                        del self._pulls[s.path, index]
+                    future.set_result(None)
+            except BaseException as e:
+                # steps waiting for the remaining pulls fail as well
+                with self._placement_lock:
+                    for s, future in pulls:
+                        if not future.done():
+                            del self._pulls[s.path, index]
+                            future.set_exception(e)
+                raise
+            for future in waits:
+                future.result()
+
+            yield [s for s, _ in pulls]
+            with self._placement_lock:
+                self._holders.setdefault(step.path, set()).add(index)
+        finally:
+            self._placement.index = None
+            with self._placement_lock:
+                self._running[index] -= 1
+
+    @property
+    def host(self) -> str:
+        index = getattr(self._placement, "index", None)
+        return "" if index is None else str(index)
+
+    def get_step_member(self, step: Step | None) -> Executor | None:
+        """
+        Get the instance to run a command of a step on: the instance of the
+        placement in this thread, or an instance that holds the result of the step.
+        :return: The instance, or None to run the command on every instance.
+        """
+        index = getattr(self._placement, "index", None)
+        if index is None and step is not None:
+            index = min(self._holders.get(step.path, {0}))
+        return None if index is None else self.members[index]
+
+    def broadcast(self, cmd: str | list[str], env: dict[str, str] | None = None):
+        """Run a command on every instance concurrently"""
+        with ThreadPoolExecutor(max_workers=len(self.members)) as pool:
+            futures = [
+                pool.submit(member.command, cmd, env=env) for member in self.members
+            ]
+        for future in futures:
+            future.result()
+
+    def command(
+        self,
+        cmd: str | list[str],
+        env: dict[str, str] | None = None,
+        step: Step | None = None,
+    ):
+        member = self.get_step_member(step)
+        if member is None:
+            self.broadcast(cmd, env=env)
+        else:
+            member.command(cmd, env=env, step=step)
+
+    def run_batch(self, commands: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Run a batch on one instance if it is placed or all commands have a step"""
+        members = {
+            id(m): m for m in map(self.get_step_member, [c["step"] for c in commands])
+        }
+        if len(members) != 1 or None in members.values():
+            return super().run_batch(commands)
+        return members.popitem()[1].run_batch(commands)
+
+    def iter_log_chunks(self, follow: bool = False, offset: int = 0) -> Iterator[bytes]:
+        """
+        Get the logs of the instances one after another, or merged line by line as
+        they are written if following. The offset counts the bytes of this stream.
+        """
+        if follow:
+            chunks = self.iter_merged_lines()
+        else:
+            chunks = (c for m in self.members for c in m.iter_log_chunks())
+
+        for chunk in chunks:
+            if offset < len(chunk):
+                yield chunk[offset:]
+            offset = max(offset - len(chunk), 0)
+
+    def iter_merged_lines(self) -> Iterator[bytes]:
+        """Follow the logs of all instances, yielding their lines as they complete"""
+        lines: Queue = Queue()
+
+        def follow(member: Executor):
+            try:
+                for line in iter_raw_lines(member.iter_log_chunks(follow=True)):
+                    lines.put(line)
+                lines.put(None)
+            except Exception as e:
+                lines.put(e)
+
+        for member in self.members:
+            Thread(target=follow, args=(member,), daemon=True).start()
+
+        remaining = len(self.members)
+        while remaining:
+            line = lines.get()
+            if isinstance(line, Exception):
+                raise line
+            if line is None:
+                remaining -= 1
+            else:
+                yield line
+
+    def get_log_sources(self) -> list[Executor]:
+        return self.members
+
+    def read_file(self, name: str, offset: int = 0, limit: int | None = None) -> bytes:
+        return self.members[0].read_file(name, offset, limit)
+
+    def read_step_logs(self, step_path: str) -> bytes:
+        """Read the output of a step from the instances that ran it"""
+        for member in self.members:
+            try:
+                return member.read_step_logs(step_path)
+            except KeyError:
+                pass
+        raise KeyError(f"No logs of step {step_path}")
 
-        self._connection = None
+    def terminate(self):
+        for member in self.members:
+            member.terminate()
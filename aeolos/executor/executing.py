@@ -36,5 +36,5 @@ class Executing:
         env: dict[str, str] | None = None,
         step: Step | None = None,
     ):
-        """Run a shell command in the executor."""
-        self.executor.command(cmd, env=env, step=step)
+        """Run a shell command in the executor, or queue it in an active batch."""
+        self.executor.dispatch(cmd, env=env, step=step)
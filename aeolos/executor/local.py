@@ -1,19 +1,67 @@
 from contextlib import contextmanager
 from pathlib import Path
+from threading import Lock
+import ctypes
+import ctypes.util
+import json
+import os
+import select
 import shlex
-from subprocess import run
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen, run
 from tempfile import TemporaryDirectory
-from typing import Iterator, TextIO
-from psutil import Process
+from typing import BinaryIO, Iterator
+from psutil import STATUS_ZOMBIE, NoSuchProcess, Process
 import time
 
 from aeolos import Executor, Step
+from .base import LOG_INDEX
+
+IN_MODIFY = 0x2
+IN_CLOEXEC = 0o2000000
+
+
+def watch_file(path: Path) -> int | None:
+    """
+    Watch a file for modifications with inotify.
+    :return: The inotify file descriptor, or None if inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(path), IN_MODIFY) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def is_running(process: Process | None) -> bool:
+    try:
+        return process is not None and process.status() != STATUS_ZOMBIE
+    except NoSuchProcess:
+        return False
+
+
+def wait_for_change(fd: int | None, timeout: float):
+    """Wait until a watched file is modified, polling if it cannot be watched"""
+    if fd is None:
+        time.sleep(min(timeout, 0.1))
+        return
+
+    readable, _, _ = select.select([fd], [], [], timeout)
+    if readable:
+        os.read(fd, 4096)
 
 
 class Local(Executor):
     def __init__(self):
         self._workdir: Path | None = None
-        self._log_file: TextIO | None = None
+        self._log_file: BinaryIO | None = None
+        self._log_lock = Lock()
 
     @property
     def workdir(self) -> Path:
@@ -44,52 +92,115 @@ class Local(Executor):
     @contextmanager
     def connect(self, address: str):
         self._workdir = Path(address)
-        with self.log_file_path.open("a") as self._log_file:
+        with self.log_file_path.open("ab") as self._log_file:
             yield
 
         self._workdir = None
         self._log_file = None
 
+    def get_local_path(self, step: Step | None = None) -> Path:
+        workdir = self.workdir
+        if step is not None:
+            workdir = workdir / step.path
+            workdir.mkdir(parents=True, exist_ok=True)
+        return workdir
+
     def command(
         self,
         cmd: str | list[str],
         env: dict[str, str] | None = None,
         step: Step | None = None,
     ):
-        workdir = self.workdir
-        if step is not None:
-            workdir = workdir / step.job_id / step.id
-            workdir.mkdir(parents=True, exist_ok=True)
+        workdir = self.get_local_path(step)
 
         if isinstance(cmd, str):
             cmd = shlex.split(cmd)
 
-        run(
-            cmd,
-            cwd=workdir,
-            env=env,
-            stdout=self._log_file,
-            stderr=self._log_file,
-            check=True,
-        )
-
-    def iter_logs(self, follow: bool = False) -> Iterator[str]:
-        with self.log_file_path.open() as log_file:
-            yield from log_file.readlines()
-
-            if follow:
-                process = self.process
-                while True:
-                    if not process.is_running():
-                        break
-
-                    line = log_file.readline()
-                    if line:
-                        yield line
-                    else:
-                        time.sleep(0.1)
-
-                yield from log_file.readlines()
+        if step is None:
+            run(
+                cmd,
+                cwd=workdir,
+                env=env,
+                stdout=self._log_file,
+                stderr=self._log_file,
+                check=True,
+            )
+            return
+
+        segment_name = self.get_segment_name(step)
+        segment_path = self.workdir / segment_name
+        segment_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with segment_path.open("ab") as segment:
+            offset = segment.tell()
+            start = time.time()
+
+            # write the output to the segment of the step and to the log
+            with Popen(cmd, cwd=workdir, env=env, stdout=PIPE, stderr=STDOUT) as proc:
+                for data in iter(lambda: proc.stdout.read1(65536), b""):
+                    segment.write(data)
+                    segment.flush()
+                    with self._log_lock:
+                        self._log_file.write(data)
+                        self._log_file.flush()
+            returncode = proc.returncode
+
+            entry = {
+                "step": step.path,
+                "file": segment_name,
+                "offset": offset,
+                "length": segment.tell() - offset,
+                "start": start,
+                "end": time.time(),
+            }
+
+        with self._log_lock, (self.workdir / LOG_INDEX).open("a") as index:
+            index.write(json.dumps(entry) + "\n")
+
+        if returncode != 0:
+            raise CalledProcessError(returncode, cmd)
+
+    def read_file(self, name: str, offset: int = 0, limit: int | None = None) -> bytes:
+        with (self.workdir / name).open("rb") as f:
+            f.seek(offset)
+            return f.read(limit)
+
+    def read_log(self, log_file: BinaryIO, follow: bool) -> Iterator[bytes]:
+        """
+        Read the log in chunks. If following, wait for new data until the executing
+        process exits.
+        """
+        if not follow:
+            yield from iter(lambda: log_file.read(65536), b"")
+            return
+
+        try:
+            process = self.process
+        except NoSuchProcess:
+            process = None
+
+        fd = watch_file(self.log_file_path)
+        try:
+            while True:
+                running = is_running(process)
+                data = log_file.read()
+                if data:
+                    yield data
+                elif not running:
+                    return
+                else:
+                    wait_for_change(fd, 1.0)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def read_logs(self, offset: int = 0, limit: int | None = None) -> bytes:
+        return self.read_file(self.log_file_path.name, offset, limit)
+
+    def iter_log_chunks(self, follow: bool = False, offset: int = 0) -> Iterator[bytes]:
+        with self.log_file_path.open("rb") as log_file:
+            log_file.seek(offset)
+            yield from self.read_log(log_file, follow)
 
     def terminate(self):
         self.process.terminate()
@@ -0,0 +1,88 @@
+from collections import deque
+from concurrent.futures import Future
+from secrets import token_hex
+from subprocess import CalledProcessError
+from threading import Lock, Thread
+
+
+class ShellSession:
+    """
+    A persistent remote shell that runs commands one after another.
+    Commands are written to the shell without waiting for the previous ones, each
+    followed by a marker line with its exit code. A reader thread matches the
+    markers to the pending commands in order, so a command costs no round trip
+    of its own.
+    """
+
+    def __init__(self, transport, shell: str = "bash"):
+        self._marker = f"__aeolos_{token_hex(8)}__".encode()
+        self._pending: deque[tuple[str, Future]] = deque()
+        self._lock = Lock()
+
+        self._channel = transport.open_session()
+        self._channel.set_combined_stderr(True)
+        self._channel.exec_command(shell)
+
+        self._reader = Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    @property
+    def active(self) -> bool:
+        return self._reader.is_alive() and not self._channel.closed
+
+    def submit(self, cmd: str) -> Future:
+        """
+        Run a command in a subshell, so that it cannot change the state of the
+        session. Its stdin is closed, the future holds its output.
+        """
+        script = (
+            f"( {cmd}\n) < /dev/null\nprintf '\\n%s %d\\n' {self._marker.decode()} $?\n"
+        )
+        future: Future = Future()
+        with self._lock:
+            if not self.active:
+                raise ConnectionError("Shell session closed")
+            self._pending.append((cmd, future))
+            self._channel.sendall(script.encode())
+        return future
+
+    def run(self, cmd: str) -> str:
+        """
+        Run a command and wait for it.
+        :raises CalledProcessError: If the command fails.
+        """
+        return self.submit(cmd).result()
+
+    def _read(self):
+        marker = b"\n" + self._marker + b" "
+        buffer = b""
+        try:
+            for data in iter(lambda: self._channel.recv(65536), b""):
+                buffer += data
+                while True:
+                    start = buffer.find(marker)
+                    end = buffer.find(b"\n", start + len(marker))
+                    if start < 0 or end < 0:
+                        break
+
+                    output = buffer[:start].decode(errors="replace")
+                    returncode = int(buffer[start + len(marker) : end])
+                    buffer = buffer[end + 1 :]
+
+                    with self._lock:
+                        cmd, future = self._pending.popleft()
+                    if returncode != 0:
+                        future.set_exception(
+                            CalledProcessError(returncode, cmd, output=output)
+                        )
+                    else:
+                        future.set_result(output)
+        finally:
+            with self._lock:
+                while self._pending:
+                    _, future = self._pending.popleft()
+                    future.set_exception(ConnectionError("Shell session closed"))
+
+    def close(self):
+        self._channel.close()
+        self._reader.join()
@@ -1,9 +1,19 @@
+from concurrent.futures import Future
 from contextlib import contextmanager
-from typing import Iterator
+from queue import Empty, LifoQueue
+from subprocess import CalledProcessError
+from threading import Lock
+from typing import Any, Callable, Iterator
 from fabric import Connection
+from paramiko import SSHException
 from secrets import token_hex
+import posixpath
+import shlex
+import sys
 
 from aeolos import Executor, Step
+from .base import LOG_INDEX
+from .shell import ShellSession
 
 
 class SSH(Executor):
@@ -13,15 +23,22 @@ class SSH(Executor):
         password: str | None = None,
         key_file: str | None = None,
         random_workdir: bool = False,
+        sessions: int = 4,
     ):
         self.uri = uri
         self.password = password
         self.key_file = key_file
         self.random_workdir = random_workdir
+        self.sessions = sessions
 
         self._connection: Connection | None = None
         self._workdir: str | None = None
 
+        self._launch_channel = None
+        self._sessions: list[ShellSession] = []
+        self._idle_sessions: LifoQueue[ShellSession] = LifoQueue()
+        self._sessions_lock = Lock()
+
     @property
     def ssh(self):
         if self._connection is None:
@@ -38,6 +55,10 @@ class SSH(Executor):
     def logfile(self) -> str:
         return self.workdir + "/__log__"
 
+    @property
+    def pidfile(self) -> str:
+        return self.workdir + "/__pid__"
+
     @contextmanager
     def setup(self) -> Iterator[str]:
         address = self.uri
@@ -68,38 +89,254 @@ class SSH(Executor):
             )
             self._workdir = result.stdout.strip()
 
-            yield
+            try:
+                yield
+            finally:
+                self.close_sessions()
+                self.stop()
             self._workdir = None
 
         self._connection = None
 
+    def start(self):
+        """
+        Run a process for as long as the launch is connected, whose PID is written
+        to the workdir, so that following the log ends with the launch. It exits
+        when its channel is closed, also if the launching process dies, and then
+        removes the PID file, so that a later follow cannot wait for a reused PID.
+        """
+        pidfile = shlex.quote(self.pidfile)
+        self._launch_channel = self.ssh.client.get_transport().open_session()
+        self._launch_channel.exec_command(
+            f"echo $$ > {pidfile}; cat > /dev/null; rm -f {pidfile}"
+        )
+
+    def stop(self):
+        if self._launch_channel is None:
+            return
+
+        self._launch_channel.close()
+        self._launch_channel = None
+        try:
+            self.ssh.run(f"rm -f {shlex.quote(self.pidfile)}", in_stream=False)
+        except (SSHException, OSError, EOFError):
+            # the connection is gone, the process removes the file when it exits
+            pass
+
+    @contextmanager
+    def session(self) -> Iterator[ShellSession]:
+        """
+        Check out a persistent shell session.
+        At most `sessions` shells are opened, so that concurrent commands do not
+        wait for each other until all of them are busy.
+        """
+        try:
+            session = self._idle_sessions.get_nowait()
+        except Empty:
+            session = None
+            with self._sessions_lock:
+                self._sessions = [s for s in self._sessions if s.active]
+                if len(self._sessions) < self.sessions:
+                    session = ShellSession(self.ssh.client.get_transport())
+                    self._sessions.append(session)
+            if session is None:
+                session = self._idle_sessions.get()
+
+        try:
+            yield session
+        finally:
+            if session.active:
+                self._idle_sessions.put(session)
+
+    def close_sessions(self):
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+            self._idle_sessions = LifoQueue()
+
     def command(
         self,
         cmd: str | list[str],
         env: dict[str, str] | None = None,
         step: Step | None = None,
     ):
-        cwd = "" if step is None else f"{step.job_id}/{step.id}"
+        with self.session() as session:
+            output = session.run(self.get_script(cmd, env, step))
+        if output:
+            sys.stderr.write(output)
+
+    def run_batch(self, commands: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """
+        Run several commands as one generated script, which reports the exit code
+        and timing of each command on a marker line and stops at the first failure.
+        """
+        marker = f"__batch_{token_hex(8)}__"
+        now = "${EPOCHREALTIME:-$(date +%s.%N)}"
+        script = ""
+        for i, command in enumerate(commands):
+            cmd_script = self.get_script(
+                command["cmd"], command["env"], command["step"]
+            )
+            script += f"""
+            start={now}
+            ( {cmd_script}
+            ) < /dev/null
+            rc=$?
+            printf '\\n{marker} {i} %d %s %s\\n' $rc $start {now}
+            [ $rc -eq 0 ] || exit $rc
+            """
+
+        failure = None
+        try:
+            with self.session() as session:
+                output = session.run(script)
+        except CalledProcessError as e:
+            failure = e
+            output = e.output
+
+        results = []
+        outputs = []
+        lines: list[str] = []
+        for line in output.splitlines():
+            if not line.startswith(marker + " "):
+                lines.append(line)
+                continue
+
+            i, returncode, start, end = line.split()[1:]
+            cmd_output = "\n".join(lines).strip("\n")
+            lines = []
+            outputs.append(cmd_output)
+
+            result = {
+                "returncode": int(returncode),
+                "start": float(start),
+                "end": float(end),
+            }
+            if result["returncode"] != 0:
+                cmd = commands[int(i)]["cmd"]
+                result["error"] = CalledProcessError(
+                    result["returncode"], cmd, output=cmd_output
+                )
+            results.append(result)
+
+        output = "\n".join(o for o in outputs + lines if o)
+        if output:
+            sys.stderr.write(output + "\n")
+
+        # the script failed outside of the commands
+        if failure is not None and not any("error" in r for r in results):
+            raise failure
+        return results
+
+    @contextmanager
+    def pipeline(self) -> Iterator[Callable[..., Future]]:
+        """
+        Submit commands to one session without waiting for each of them.
+        They run in order, all of them are waited for on exit.
+        :return: A function with the arguments of `command` that returns a future.
+        :raises CalledProcessError: The first error of a failed command, on exit.
+        """
+        with self.session() as session:
+            futures: list[Future] = []
+
+            def submit(
+                cmd: str | list[str],
+                env: dict[str, str] | None = None,
+                step: Step | None = None,
+            ) -> Future:
+                future = session.submit(self.get_script(cmd, env, step))
+                futures.append(future)
+                return future
+
+            try:
+                yield submit
+            finally:
+                errors = [f.exception() for f in futures]
+
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def get_script(
+        self,
+        cmd: str | list[str],
+        env: dict[str, str] | None = None,
+        step: Step | None = None,
+    ) -> str:
+        """
+        Get the shell script running a command in the workdir of a step.
+        Workdirs are only created if they do not exist, testing with a shell builtin.
+        """
+        cwd = "" if step is None else step.path
         workdir = f"{self.workdir}/{cwd}"
 
         if isinstance(cmd, list):
-            cmd = " ".join(cmd)
+            cmd = shlex.join(cmd)
+
+        exports = "".join(
+            f"export {key}={shlex.quote(value)}\n" for key, value in (env or {}).items()
+        )
+        mkdir = f"{{ [ -d {workdir} ] || mkdir -p {workdir}; }} && "
+
+        if step is None:
+            return f"{exports}{mkdir}cd {workdir} && {cmd} >> {self.logfile}"
 
-        cmd = f"""
-        mkdir -p {workdir} &&
-        cd {workdir} &&
-        {cmd} >> {self.logfile}
+        # write the output to the segment of the step and to the log, then index it
+        segment_name = self.get_segment_name(step)
+        segment = shlex.quote(f"{self.workdir}/{segment_name}")
+        segment_dir = shlex.quote(posixpath.dirname(f"{self.workdir}/{segment_name}"))
+        entry = (
+            f'{{"step": "{step.path}", "file": "{segment_name}", '
+            '"offset": %s, "length": %s, "start": %s, "end": %s}\\n'
+        )
+        mkdir += f"{{ [ -d {segment_dir} ] || mkdir -p {segment_dir}; }} && "
+        return f"""
+        {exports}set -o pipefail
+        {mkdir}cd {workdir} || exit 1
+        offset=$(stat -c %s {segment} 2>/dev/null || echo 0)
+        start=$(date +%s.%N)
+        {{ {cmd}
+        }} | tee -a {segment} >> {self.logfile}
+        rc=$?
+        length=$(( $(stat -c %s {segment}) - offset ))
+        printf {shlex.quote(entry)} $offset $length $start $(date +%s.%N) \\
+            >> {self.workdir}/{LOG_INDEX}
+        exit $rc
         """
-        self.ssh.run(cmd.strip(), env=env, in_stream=False, out_stream=False)
 
-    def iter_logs(self, follow: bool = False) -> Iterator[str]:
-        cmd = f"cat {self.logfile}"
+    def read_file(self, name: str, offset: int = 0, limit: int | None = None) -> bytes:
+        path = shlex.quote(f"{self.workdir}/{name}")
+        cmd = f"test -f {path} && tail -c +{offset + 1} {path}"
+        if limit is not None:
+            cmd += f" | head -c {limit}"
+        return b"".join(self.stream(cmd))
+
+    def iter_log_chunks(self, follow: bool = False, offset: int = 0) -> Iterator[bytes]:
+        """
+        Stream the log over a single channel. If following, `tail -F` keeps the
+        channel open until the process of the launch exits.
+        """
+        logfile, pidfile = shlex.quote(self.logfile), shlex.quote(self.pidfile)
+        cmd = f"tail -c +{offset + 1} {logfile}"
+        if follow:
+            cmd = (
+                f"if [ -f {pidfile} ]; then {cmd} -F --pid=$(cat {pidfile});"
+                f" else {cmd}; fi"
+            )
+        yield from self.stream(cmd)
+
+    def read_logs(self, offset: int = 0, limit: int | None = None) -> bytes:
+        return self.read_file("__log__", offset, limit)
 
-        proc = self.ssh.run(cmd, in_stream=False)
-        for line in proc.stdout.split("\n"):
-            line = line.strip()
-            if line:
-                yield line
+    def stream(self, cmd: str) -> Iterator[bytes]:
+        """Run a command on its own channel and yield its output as it arrives"""
+        channel = self.ssh.client.get_transport().open_session()
+        try:
+            channel.exec_command(cmd)
+            yield from iter(lambda: channel.recv(65536), b"")
+        finally:
+            channel.close()
 
     def terminate(self):
         if self._connection is None:
@@ -10,3 +10,7 @@ class Repository(ABC, ConfigurableObject, Executing):
     def run(self, step: Step):
         """Run a step"""
         ...
+
+    def prefetch(self, steps: list[Step]):
+        """Start fetching what the steps to run need, without waiting for it"""
+        pass
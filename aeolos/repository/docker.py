@@ -1,21 +1,144 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from hashlib import sha256
+from secrets import token_hex
+from threading import Lock
+from urllib.request import Request, urlopen
 import shlex
 
 from aeolos import Step, Repository
 
 
 class DockerRunner(Repository):
-    def get_image(self, step: Step) -> str:
+    pull_workers: int = 4
+    """Number of images fetched concurrently by `prefetch`"""
+
+    warm: bool = False
+    """Run steps with `docker exec` in one container per image and arguments"""
+
+    _pool: ThreadPoolExecutor | None = None
+    _fetches: dict[str, Future] | None = None
+    _containers: dict[tuple[str, ...], Future] | None = None
+    _containers_lock: "Lock | None" = None
+
+    @contextmanager
+    def setup(self):
+        self._pool = ThreadPoolExecutor(max_workers=self.pull_workers)
+        self._fetches = {}
+        self._containers = {}
+        self._containers_lock = Lock()
+        try:
+            yield
+        finally:
+            try:
+                self.remove_containers()
+            finally:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+                self._fetches = None
+                self._containers = None
+                self._containers_lock = None
+
+    def get_image_name(self, step: Step) -> str:
         image = step.command
         if "tag" in step.config:
             image += ":" + step.config["tag"]
         return image
 
+    def fetch_image(self, image: str, step: Step):
+        """Make the image of a step available on the executor"""
+        pass
+
+    def prefetch(self, steps: list[Step]):
+        """Fetch the images of the steps concurrently in the background"""
+        for step in steps:
+            image = self.get_image_name(step)
+            if image not in self._fetches:
+                future = self._pool.submit(self.fetch_image, image, step)
+                self._fetches[image] = future
+
+    def get_image(self, step: Step) -> str:
+        """Get the image of a step, waiting for it if it is prefetched"""
+        image = self.get_image_name(step)
+        future = (self._fetches or {}).get(image)
+        if future is not None:
+            future.result()
+        else:
+            self.fetch_image(image, step)
+        return image
+
+    def is_reusable(self, step: Step) -> bool:
+        """
+        Whether a step can run in a warm container. Steps that ask for `isolated`
+        containers, mount a `workspace` or run the default command of their image
+        get a fresh container.
+        """
+        return self.warm and not (
+            step.config.get("isolated")
+            or "workspace" in step.config
+            or "command" not in step.config
+        )
+
+    def get_container(self, step: Step) -> str:
+        """
+        Get the warm container of the image and docker arguments of a step on the
+        host of the executor, starting it if needed. Steps that need the same
+        container while it starts wait for it.
+        """
+        image = self.get_image(step)
+        key = (self.executor.host, image, *step.config.get("docker_args", []))
+        with self._containers_lock:
+            future = self._containers.get(key)
+            starting = future is None
+            if starting:
+                future = self._containers[key] = Future()
+
+        if starting:
+            name = f"aeolos_{token_hex(6)}"
+            args = [
+                "--name",
+                name,
+                "--entrypoint",
+                "tail",
+                *step.config.get("docker_args", []),
+                image,
+                "-f",
+                "/dev/null",
+            ]
+            script = f"docker run -d --rm {shlex.join(args)} > /dev/null"
+            try:
+                self.command(["sh", "-c", script])
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            future.set_result(name)
+        return future.result()
+
+    def remove_containers(self):
+        with self._containers_lock:
+            futures = list(self._containers.values())
+            self._containers.clear()
+        names = [f.result() for f in futures if f.done() and f.exception() is None]
+        if names:
+            # the containers of executors with several hosts are spread over them
+            script = f"docker rm -f {shlex.join(names)} > /dev/null 2>&1 || true"
+            self.command(["sh", "-c", script])
+
     def run(self, step: Step):
+        container = self.get_container(step) if self.is_reusable(step) else None
+        with self.executor.batch():
+            self.run_commands(step, container)
+
+    def run_commands(self, step: Step, container: str | None = None):
+        """
+        Run the commands of a step, which are sent to the executor as one batch.
+        :param container: The warm container to run the command in, if any.
+        """
         self.command("echo", step=step)
 
         args = []
         if "workspace" in step.config:
-            args += ["-v", f"{step.job_id}/{step.id}:{step.config['workspace']}"]
+            args += ["-v", f"{step.path}:{step.config['workspace']}"]
 
         for key, val in step.config.get("env", {}).items():
             if val:
@@ -23,6 +146,12 @@ class DockerRunner(Repository):
             else:
                 args += ["-e", key]
 
+        if container is not None:
+            # the image's workdir is kept, like in a fresh container
+            command = shlex.split(step.config["command"])
+            self.command(["docker", "exec", *args, container, *command], step=step)
+            return
+
         if "docker_args" in step.config:
             args += step.config["docker_args"]
 
@@ -36,25 +165,110 @@ class DockerRunner(Repository):
 
 
 class DockerImporter(DockerRunner):
-    def __init__(self, url: str):
+    """
+    Imports the images of the steps from tarballs at `<url>/<command>.tgz`.
+    Imported images are tagged with a key of the URL and the ETag, Last-Modified
+    and size of the tarball, or with the `digest` declared in the step config, so
+    that a tarball is imported once and reused by later launches on the same host.
+    """
+
+    def __init__(self, url: str, pull_workers: int = 4, warm: bool = False):
         self.url = url
+        self.pull_workers = pull_workers
+        self.warm = warm
 
-    def get_image(self, step: Step) -> str:
-        image = step.command
-        self.command(["docker", "import", f"{self.url}/{step.command}.tgz", image])
-        return image
+        self._keys: dict[str, str | None] = {}
+        self._keys_lock = Lock()
+
+    def get_tarball_url(self, step: Step) -> str:
+        return f"{self.url}/{step.command}.tgz"
+
+    def get_import_key(self, step: Step) -> str | None:
+        """
+        Get the key of the tarball of a step, requesting its headers once.
+        :return: The key, or None if the tarball cannot be identified.
+        """
+        if "digest" in step.config:
+            return step.config["digest"].removeprefix("sha256:")
+
+        url = self.get_tarball_url(step)
+        with self._keys_lock:
+            if url in self._keys:
+                return self._keys[url]
+
+        # request without the lock, so that a slow URL does not block other images
+        try:
+            with urlopen(Request(url, method="HEAD"), timeout=30) as response:
+                headers = [
+                    response.headers.get(name, "")
+                    for name in ("ETag", "Last-Modified", "Content-Length")
+                ]
+        except (OSError, ValueError):
+            headers = []
+
+        key = None
+        if any(headers):
+            key = sha256("\n".join([url] + headers).encode()).hexdigest()
+        with self._keys_lock:
+            return self._keys.setdefault(url, key)
+
+    def get_image_name(self, step: Step) -> str:
+        key = self.get_import_key(step)
+        if key is None:
+            return step.command
+        return f"{step.command}:{key[:16]}"
+
+    def fetch_image(self, image: str, step: Step):
+        url = self.get_tarball_url(step)
+        if self.get_import_key(step) is None:
+            self.command(["docker", "import", url, image])
+            return
+
+        url, image = shlex.quote(url), shlex.quote(image)
+        script = (
+            f"docker image inspect {image} > /dev/null 2>&1"
+            f" || docker import {url} {image}"
+        )
+        self.command(["sh", "-c", script])
 
 
 class DockerRegistry(DockerRunner):
-    def __init__(self, url: str = ""):
+    """
+    Pulls the images of the steps from a registry.
+    With `pull="missing"`, images that are present are not pulled again. Images
+    pinned by digest are only pulled if they are missing in any case, since their
+    content cannot change.
+    """
+
+    def __init__(
+        self,
+        url: str = "",
+        pull: str = "always",
+        pull_workers: int = 4,
+        warm: bool = False,
+    ):
+        if pull not in ("always", "missing"):
+            raise ValueError("Pull policy must be always or missing")
+
         self.url = url
+        self.pull = pull
+        self.pull_workers = pull_workers
+        self.warm = warm
 
-    def get_image(self, step: Step) -> str:
+    def get_image_name(self, step: Step) -> str:
         image = step.command
         if self.url:
             image = self.url + "/" + image
         if "tag" in step.config:
             image += ":" + step.config["tag"]
-
-        self.command(["docker", "pull", image], step=step)
         return image
+
+    def fetch_image(self, image: str, step: Step):
+        if self.pull == "missing" or "@sha256:" in image:
+            image = shlex.quote(image)
+            script = (
+                f"docker image inspect {image} > /dev/null 2>&1 || docker pull {image}"
+            )
+            self.command(["sh", "-c", script], step=step)
+        else:
+            self.command(["docker", "pull", image], step=step)
@@ -1,11 +1,37 @@
 from abc import ABC, abstractmethod
+from hashlib import sha256
+from pathlib import Path
+from subprocess import CalledProcessError
+from typing import Any
+import json
+import shlex
+import time
 
 from aeolos import Step
 from aeolos.utils import ConfigurableObject
 from aeolos.executor.executing import Executing
+from . import transfer
+
+# exit code of a transfer if the transfer module is not on the executor yet
+UPLOAD_REQUIRED = 111
+UPLOAD_MARKER = "__AEOLOS_TRANSFER__"
 
 
 class Storage(ABC, ConfigurableObject, Executing):
+    manifest: bool = False
+    """Keep the metadata of a job in a single manifest document"""
+
+    content_addressed: bool = False
+    """Store step results by fingerprint, so that they are shared between jobs"""
+
+    pack: str | None = None
+    """Store step results as a tar archive compressed with gzip or zstd"""
+    pack_level: int | None = None
+    pack_chunk_size: int = 64 * transfer.MB
+
+    python: str = "python3"
+    """Python interpreter of the executor, used to run transfers remotely"""
+
     @abstractmethod
     def pull(self, step: Step):
         """Pull the result of a step from the storage to the executor"""
@@ -16,6 +42,10 @@ class Storage(ABC, ConfigurableObject, Executing):
         """Push the result of a step from the executor to the storage"""
         ...
 
+    def record_access(self, step: Step):
+        """Record that the result of a step was read, for garbage collection"""
+        pass
+
     @abstractmethod
     def get_meta(self, key: str):
         """Get a metadata entry"""
@@ -26,19 +56,306 @@ class Storage(ABC, ConfigurableObject, Executing):
         """Set a metadata entry"""
         ...
 
+    def get_blob(self, key: str) -> bytes:
+        """
+        Get a binary entry.
+        :raises KeyError: If the entry does not exist.
+        """
+        raise RuntimeError("Not supported")
+
+    def set_blob(self, key: str, data: bytes):
+        """Set a binary entry"""
+        raise RuntimeError("Not supported")
+
+    def get_location(self, step: Step) -> str:
+        """Get the path of the stored result of a step"""
+        if self.content_addressed:
+            return f"__objects__/{step.sha256()}"
+        return step.path
+
+    def get_pack_args(self) -> dict[str, Any] | None:
+        if self.pack is None:
+            return None
+        return {
+            "compression": self.pack,
+            "level": self.pack_level,
+            "chunk_size": self.pack_chunk_size,
+        }
+
+    def run_transfer(
+        self,
+        step: Step,
+        args: dict[str, Any],
+        env: dict[str, str] | None = None,
+        local_args: dict[str, Any] | None = None,
+    ):
+        """
+        Transfer a step directory with the transfer module.
+        Runs in this process with `local_args` added if the executor workdir is
+        local, otherwise the transfer module is run by the python interpreter of the
+        executor. The module is uploaded to the executor once per version.
+        """
+        args = args | {
+            "outputs": step.outputs,
+            "exclude": step.exclude,
+            "pack": self.get_pack_args(),
+        }
+
+        local_path = self.executor.get_local_path(step)
+        if local_path is not None:
+            transfer.main(args | {"directory": str(local_path)} | (local_args or {}))
+            return
+
+        source = Path(transfer.__file__).read_text()
+        digest = sha256(source.encode()).hexdigest()[:16]
+        path = f'"$HOME/.cache/aeolos/transfer_{digest}.py"'
+        arg = shlex.quote(json.dumps(args | {"directory": "."}))
+        cmd = f"[ -f {path} ] || exit {UPLOAD_REQUIRED}\n{self.python} {path} {arg}"
+        try:
+            self.command(cmd, env=env, step=step)
+        except CalledProcessError as e:
+            if e.returncode != UPLOAD_REQUIRED:
+                raise
+            self.upload_transfer(path, source)
+            self.command(cmd, env=env, step=step)
+
+    def upload_transfer(self, path: str, source: str):
+        """Upload the transfer module to the executor, once per version"""
+        cmd = (
+            'mkdir -p "$HOME/.cache/aeolos"'
+            f" && cat > {path}.$$ << '{UPLOAD_MARKER}'\n{source}\n{UPLOAD_MARKER}\n"
+            f"mv {path}.$$ {path}"
+        )
+        self.command(cmd)
+
+    def get_meta_many(self, keys: list[str]) -> dict[str, str]:
+        """Get several metadata entries, leaving out the ones that do not exist"""
+        values = {}
+        for key in keys:
+            try:
+                values[key] = self.get_meta(key)
+            except KeyError:
+                pass
+        return values
+
+    def set_meta_many(self, entries: dict[str, str]):
+        """Set several metadata entries"""
+        for key, value in entries.items():
+            self.set_meta(key, value)
+
+    def read_manifest(self, job_id: str) -> tuple[dict[str, Any], str | None]:
+        """
+        Read the manifest of a job.
+        :return: The manifest and its version, or an empty manifest and None if the
+            manifest does not exist.
+        """
+        raise RuntimeError("Not supported")
+
+    def write_manifest(
+        self, job_id: str, manifest: dict[str, Any], version: str | None
+    ) -> bool:
+        """
+        Write the manifest of a job, if it is still at the version that was read.
+        :return: False if the manifest was changed concurrently.
+        """
+        raise RuntimeError("Not supported")
+
+    def get_job_meta(self, job_id: str, keys: list[str]) -> dict[str, str]:
+        """
+        Get metadata entries of a job, leaving out the ones that do not exist.
+        In manifest mode, all entries are read from the manifest in one request.
+        """
+        if self.manifest:
+            entries = self.read_manifest(job_id)[0].get("entries", {})
+            return {key: entries[key]["value"] for key in keys if key in entries}
+
+        values = self.get_meta_many([f"{job_id}/{key}" for key in keys])
+        return {
+            key: values[f"{job_id}/{key}"]
+            for key in keys
+            if f"{job_id}/{key}" in values
+        }
+
+    def set_job_meta(self, job_id: str, entries: dict[str, str]):
+        """
+        Set metadata entries of a job.
+        In manifest mode, the manifest is updated with optimistic concurrency.
+        """
+        if not self.manifest:
+            self.set_meta_many({f"{job_id}/{k}": v for k, v in entries.items()})
+            return
+
+        while True:
+            manifest, version = self.read_manifest(job_id)
+            updated = time.time()
+            manifest["version"] = manifest.get("version", 0) + 1
+            manifest.setdefault("entries", {}).update(
+                {k: {"value": v, "updated": updated} for k, v in entries.items()}
+            )
+            if self.write_manifest(job_id, manifest, version):
+                return
+
     def is_done(self, step: Step) -> bool:
         """Check if a step is done"""
-        try:
-            sha256 = self.get_meta(f"{step.job_id}/{step.id}/__done__")
-            return sha256 == step.sha256()
-        except KeyError:
-            return False
+        return self.is_done_many([step])[0]
+
+    def is_done_many(self, steps: list[Step]) -> list[bool]:
+        """
+        Check which of several steps are done.
+        If content addressed, a step is done if any job stored its result.
+        """
+        if self.content_addressed:
+            keys = [f"{self.get_location(step)}/__done__" for step in steps]
+            objects = self.get_meta_many(keys)
+            return [key in objects for key in keys]
+
+        values: dict[str, dict[str, str]] = {}
+        for job_id in {step.job_id for step in steps}:
+            keys = [f"{s.name}/__done__" for s in steps if s.job_id == job_id]
+            values[job_id] = self.get_job_meta(job_id, keys)
+
+        return [
+            values[step.job_id].get(f"{step.name}/__done__") == step.sha256()
+            for step in steps
+        ]
 
     def mark_done(self, step: Step) -> bool:
         """Mark a step as done"""
-        self.set_meta(f"{step.job_id}/{step.id}/__done__", step.sha256())
+        if self.content_addressed:
+            self.set_meta(f"{self.get_location(step)}/__done__", step.sha256())
+        self.set_job_meta(step.job_id, {f"{step.name}/__done__": step.sha256()})
 
     def store(self, step: Step):
         """Put the result of a step in the storage"""
         self.push(step)
         self.mark_done(step)
+
+    def set_job_state(self, job_id: str, state: str):
+        """Record the state of a job, if the storage keeps an index of jobs"""
+        pass
+
+    def set_step_state(self, step: Step, state: str, duration: float | None = None):
+        """Record the state of a step, if the storage keeps an index of jobs"""
+        pass
+
+    def list_jobs(
+        self, state: str | None = None, since: float | None = None
+    ) -> list[dict[str, Any]]:
+        """
+        List the indexed jobs, optionally only the ones in a state or updated since
+        a timestamp.
+        """
+        raise RuntimeError("Not supported")
+
+    @staticmethod
+    def get_result_location(key: str) -> str | None:
+        """
+        Get the location of the stored result a key belongs to, i.e. the stage
+        directory `<job>/<stage>`, `__objects__/<fingerprint>` or the logs of a job.
+        Other job metadata does not belong to a result.
+        """
+        parts = key.strip("/").split("/")
+        if len(parts) >= 3 or (len(parts) == 2 and parts[1] == "__logs__"):
+            return "/".join(parts[:2])
+        return None
+
+    def list_results(self) -> list[dict[str, Any]]:
+        """
+        List the stored results with their `location`, `size` in bytes and
+        `last_access` timestamp.
+        """
+        raise RuntimeError("Not supported")
+
+    def delete_results(self, locations: list[str]):
+        """Delete stored results by location"""
+        raise RuntimeError("Not supported")
+
+    def drop_job_meta(self, job_id: str, prefixes: list[str]):
+        """Remove the manifest entries of a job below several prefixes"""
+        while True:
+            manifest, version = self.read_manifest(job_id)
+            if version is None:
+                return
+
+            entries = manifest.get("entries", {})
+            keys = [k for k in entries if any(k.startswith(p) for p in prefixes)]
+            if not keys:
+                return
+
+            manifest["version"] += 1
+            for key in keys:
+                del entries[key]
+            if self.write_manifest(job_id, manifest, version):
+                return
+
+    def get_running_jobs(self, job_ids: list[str]) -> set[str]:
+        """
+        Get the jobs that are running, by their indexed state if the storage keeps
+        an index of jobs, or by the steps they are running.
+        """
+        running = set()
+        try:
+            running |= {job["id"] for job in self.list_jobs(state="running")}
+        except RuntimeError:
+            pass
+
+        for job_id in set(job_ids) - running:
+            if self.get_job_meta(job_id, ["__step__"]).get("__step__"):
+                running.add(job_id)
+        return running
+
+    def collect_garbage(
+        self,
+        keep: list[Step],
+        budget: int | None = None,
+        max_age: float | None = None,
+        dry_run: bool = False,
+    ) -> list[dict[str, Any]]:
+        """
+        Delete stored results that do not belong to the steps to keep or to a
+        running job. Content addressed objects of other jobs are only kept if their
+        steps are passed to keep.
+        Results not accessed for `max_age` seconds are deleted first, then the least
+        recently accessed results until all results fit into `budget` bytes.
+        :return: The deleted results.
+        """
+        kept = {"/".join(self.get_location(step).split("/")[:2]) for step in keep}
+        kept |= {f"{step.job_id}/__logs__" for step in keep}
+
+        results = self.list_results()
+        job_ids = {result["location"].split("/")[0] for result in results}
+        running = self.get_running_jobs(sorted(job_ids - {"__objects__"}))
+        candidates = sorted(
+            (
+                result
+                for result in results
+                if result["location"] not in kept
+                and result["location"].split("/")[0] not in running
+            ),
+            key=lambda result: result["last_access"],
+        )
+
+        deleted = []
+        total = sum(result["size"] for result in results)
+        now = time.time()
+        for result in candidates:
+            expired = max_age is not None and now - result["last_access"] > max_age
+            if not expired and (budget is None or total <= budget):
+                continue
+            deleted.append(result)
+            total -= result["size"]
+
+        if deleted and not dry_run:
+            locations = [result["location"] for result in deleted]
+            self.delete_results(locations)
+
+            if self.manifest:
+                prefixes: dict[str, list[str]] = {}
+                for location in locations:
+                    job_id, name = location.split("/")
+                    prefixes.setdefault(job_id, []).append(name + "/")
+                for job_id, job_prefixes in prefixes.items():
+                    if job_id != "__objects__":
+                        self.drop_job_meta(job_id, job_prefixes)
+
+        return deleted
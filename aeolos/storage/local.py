@@ -1,14 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
+from secrets import token_hex
+from typing import Any
+import errno
+import fcntl
+import json
+import os
+import shutil
 
 from .base import Storage
+from .sqlite import SQLiteIndex
+from .transfer import MB, is_selected, select_files
 
 from aeolos import Step
 
+LINK_MODES = ("copy", "hardlink", "reflink", "auto")
+FICLONE = 0x40049409
+
+
+def reflink(src: Path, dst: Path):
+    """Clone a file sharing its blocks copy-on-write, if the filesystem supports it"""
+    with src.open("rb") as src_file, dst.open("wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst.unlink()
+            raise
+
+
+def link_file(src: Path, dst: Path, mode: str):
+    """
+    Link or copy a file according to the link mode.
+    Files are never hard linked, since a stored result would share its content
+    with the workdir, where read-only files do not stop steps running as root
+    from changing it. `hardlink` and `auto` clone copy-on-write reflinks like
+    `reflink`, which fall back to a copy if they are not supported, e.g. across
+    devices.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists():
+        if dst.samefile(src):
+            return
+        dst.unlink()
+
+    fallback_errors = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL)
+    if mode != "copy":
+        try:
+            reflink(src, dst)
+            return
+        except OSError as e:
+            if e.errno not in fallback_errors:
+                raise
+    shutil.copy2(src, dst)
+
+
+def link_tree(src: Path, dst: Path, step: Step, mode: str):
+    """Link or copy the declared outputs of a step from one directory into another"""
+    for path in select_files(src, step.outputs, step.exclude):
+        name = path.relative_to(src).as_posix()
+        if name not in ("__done__", "__files__"):
+            link_file(path, dst / name, mode)
+
 
 class Local(Storage):
-    def __init__(self, basepath: str):
+    def __init__(
+        self,
+        basepath: str,
+        manifest: bool = False,
+        content_addressed: bool = False,
+        pack: str | None = None,
+        pack_level: int | None = None,
+        pack_chunk_size: int = 64 * MB,
+        file_workers: int = 4,
+        python: str = "python3",
+        link_mode: str = "copy",
+        sqlite: bool = False,
+    ):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Link mode must be one of {', '.join(LINK_MODES)}")
+
         self.basepath = Path(basepath)
+        self.manifest = manifest
+        self.content_addressed = content_addressed
+        self.pack = pack
+        self.pack_level = pack_level
+        self.pack_chunk_size = pack_chunk_size
+        self.file_workers = file_workers
+        self.python = python
+        self.link_mode = link_mode
+        self.sqlite = sqlite
+        self._index = SQLiteIndex(self.basepath / "__meta__.db") if sqlite else None
 
     @contextmanager
     def setup(self):
@@ -18,22 +100,258 @@ class Local(Storage):
         finally:
             self.command(["cp", "__log__", self.basepath.as_posix()])
 
+    @staticmethod
+    def get_rsync_rules(pattern: str) -> list[str]:
+        """Translate an output pattern into rsync filter patterns"""
+        pattern = pattern.strip("/")
+        rules = [f"/{pattern}", f"/{pattern}/**"]
+        if pattern.startswith("**/"):
+            rules += [f"/{pattern[3:]}", f"/{pattern[3:]}/**"]
+        return rules
+
+    def get_filter_args(self, step: Step) -> list[str]:
+        """Get the rsync arguments selecting the declared outputs of a step"""
+        args = []
+        for pattern in step.exclude or []:
+            args += [f"--exclude={rule}" for rule in self.get_rsync_rules(pattern)]
+
+        if step.outputs is not None:
+            args += ["--include=*/"]
+            for pattern in step.outputs:
+                args += [f"--include={rule}" for rule in self.get_rsync_rules(pattern)]
+            args += ["--exclude=*", "--prune-empty-dirs"]
+
+        return args
+
+    def transfer(self, action: str, step: Step):
+        """Pack or unpack a step directory"""
+        target = (self.basepath / self.get_location(step)).absolute()
+        args = {
+            "action": action,
+            "target": target.as_posix(),
+            "file_workers": self.file_workers,
+        }
+        self.run_transfer(step, args)
+
     def pull(self, step: Step):
-        step_path = self.basepath / step.job_id / step.id
-        self.command(["rsync", "-a", step_path.as_posix() + "/", "."], step=step)
+        step_path = self.basepath / self.get_location(step)
+        if not step_path.exists():
+            # steps that were only marked done have no stored result
+            return
+        self.record_access(step)
+
+        if self.pack is not None:
+            self.transfer("unpack", step)
+            return
+
+        local_path = self.executor.get_local_path(step)
+        if self.link_mode != "copy" and local_path is not None:
+            link_tree(step_path, local_path, step, self.link_mode)
+            return
+
+        cmd = ["rsync", "-a", *self.get_filter_args(step), step_path.as_posix() + "/"]
+        self.command(cmd + ["."], step=step)
+
+    def record_access(self, step: Step):
+        try:
+            os.utime(self.basepath / self.get_location(step))
+        except FileNotFoundError:
+            pass
 
     def push(self, step: Step):
-        step_path = self.basepath / step.job_id / step.id
+        step_path = self.basepath / self.get_location(step)
         step_path.mkdir(parents=True, exist_ok=True)
-        self.command(["rsync", "-a", ".", step_path.as_posix()], step=step)
+        if self.pack is not None:
+            self.transfer("pack", step)
+            return
+
+        local_path = self.executor.get_local_path(step)
+        if self.link_mode != "copy" and local_path is not None:
+            link_tree(local_path, step_path, step, self.link_mode)
+        else:
+            cmd = ["rsync", "-a", *self.get_filter_args(step), "."]
+            self.command(cmd + [step_path.as_posix()], step=step)
+
+        if step.outputs is not None or step.exclude is not None:
+            self.set_meta(
+                f"{self.get_location(step)}/__files__",
+                json.dumps(self.list_files(step)),
+            )
+
+    def list_files(self, step: Step) -> list[str]:
+        """List the stored files of a step that match its declared outputs"""
+        step_path = self.basepath / self.get_location(step)
+        files = []
+        for path in sorted(step_path.rglob("*")):
+            name = path.relative_to(step_path).as_posix()
+            if name in ("__done__", "__files__") or not path.is_file():
+                continue
+            if is_selected(name, step.outputs, step.exclude):
+                files.append(name)
+        return files
 
     def get_meta(self, key: str) -> str:
+        if self._index is not None:
+            try:
+                return self._index.get_many([key])[key]
+            except KeyError:
+                raise KeyError(f"Metadata entry {key} does not exist")
+
         meta_file = self.basepath / key
         if not meta_file.exists():
             raise KeyError(f"Metadata entry {key} does not exist")
         return meta_file.read_text()
 
+    def get_blob(self, key: str) -> bytes:
+        try:
+            return (self.basepath / key).read_bytes()
+        except FileNotFoundError:
+            raise KeyError(f"Entry {key} does not exist")
+
+    def set_blob(self, key: str, data: bytes):
+        path = self.basepath / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    def get_meta_many(self, keys: list[str]) -> dict[str, str]:
+        """Get several metadata entries, scanning each directory once"""
+        if self._index is not None:
+            return self._index.get_many(keys)
+
+        by_dir: dict[Path, list[str]] = {}
+        for key in keys:
+            by_dir.setdefault((self.basepath / key).parent, []).append(key)
+
+        values = {}
+        for directory, dir_keys in by_dir.items():
+            try:
+                with os.scandir(directory) as entries:
+                    files = {entry.name for entry in entries if entry.is_file()}
+            except FileNotFoundError:
+                continue
+
+            for key in dir_keys:
+                meta_file = self.basepath / key
+                if meta_file.name in files:
+                    values[key] = meta_file.read_text()
+        return values
+
     def set_meta(self, key: str, value: str):
+        if self._index is not None:
+            self._index.set_many({key: value})
+            return
+
         meta_file = self.basepath / key
         meta_file.parent.mkdir(parents=True, exist_ok=True)
         meta_file.write_text(value)
+
+    def set_meta_many(self, entries: dict[str, str]):
+        if self._index is not None:
+            self._index.set_many(entries)
+            return
+        super().set_meta_many(entries)
+
+    def set_job_state(self, job_id: str, state: str):
+        if self._index is not None:
+            self._index.set_job_state(job_id, state)
+
+    def set_step_state(self, step: Step, state: str, duration: float | None = None):
+        if self._index is None:
+            return
+
+        size = None
+        location = self.get_location(step)
+        if state == "done" and (self.basepath / location).exists():
+            size = self.get_result(location)["size"]
+        self._index.set_step_state(
+            step.job_id, step.name, step.sha256(), state, duration, size
+        )
+
+    def list_jobs(
+        self, state: str | None = None, since: float | None = None
+    ) -> list[dict[str, Any]]:
+        if self._index is None:
+            raise RuntimeError("Not supported")
+        return self._index.list_jobs(state, since)
+
+    def get_result(self, location: str) -> dict[str, Any]:
+        """Get the size and last access time of a stored result"""
+        path = self.basepath / location
+        if path.is_dir():
+            stats = [
+                os.lstat(os.path.join(dirpath, name))
+                for dirpath, _, filenames in os.walk(path)
+                for name in filenames
+            ]
+        else:
+            stats = [path.stat()]
+
+        return {
+            "location": location,
+            "size": sum(s.st_size for s in stats),
+            "last_access": max(
+                [path.stat().st_mtime] + [max(s.st_atime, s.st_mtime) for s in stats]
+            ),
+        }
+
+    def list_results(self) -> list[dict[str, Any]]:
+        """List the stored results, walking their directories in parallel"""
+        locations = []
+        for job_path in self.basepath.iterdir():
+            if not job_path.is_dir():
+                continue
+            for path in job_path.iterdir():
+                location = path.relative_to(self.basepath).as_posix()
+                if path.is_dir() or self.get_result_location(location) is not None:
+                    locations.append(location)
+
+        with ThreadPoolExecutor(max_workers=self.file_workers) as pool:
+            results = list(pool.map(self.get_result, locations))
+
+        if self._index is not None:
+            results += [
+                {"location": key, "size": size, "last_access": updated}
+                for key, size, updated in self._index.list_meta("/__logs__")
+                if self.get_result_location(key) == key
+            ]
+        return results
+
+    def delete_results(self, locations: list[str]):
+        def delete(location: str):
+            path = self.basepath / location
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink(missing_ok=True)
+
+        with ThreadPoolExecutor(max_workers=self.file_workers) as pool:
+            list(pool.map(delete, locations))
+
+        if self._index is not None:
+            self._index.delete_meta(locations)
+
+    def get_manifest_path(self, job_id: str) -> Path:
+        return self.basepath / job_id / "__manifest__.json"
+
+    def read_manifest(self, job_id: str) -> tuple[dict[str, Any], str | None]:
+        try:
+            manifest = json.loads(self.get_manifest_path(job_id).read_text())
+        except FileNotFoundError:
+            return {}, None
+        return manifest, str(manifest["version"])
+
+    def write_manifest(
+        self, job_id: str, manifest: dict[str, Any], version: str | None
+    ) -> bool:
+        path = self.get_manifest_path(job_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        with path.with_suffix(".lock").open("a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.read_manifest(job_id)[1] != version:
+                return False
+
+            tmp_path = path.with_suffix(f".{token_hex(4)}.tmp")
+            tmp_path.write_text(json.dumps(manifest))
+            os.replace(tmp_path, path)
+            return True
@@ -0,0 +1,150 @@
+from contextlib import contextmanager
+from threading import Event, Thread
+from typing import Iterator
+import io
+import json
+
+from aeolos import Executor, Storage
+from . import transfer
+
+LOG_EXTENSIONS = {None: "log", "gzip": "log.gz", "zstd": "log.zst"}
+
+
+def get_log_chunk_name(index: int, compression: str | None) -> str:
+    return f"__logs__/{index:05d}.{LOG_EXTENSIONS[compression]}"
+
+
+def compress_chunk(data: bytes, compression: str | None) -> bytes:
+    if compression is None:
+        return data
+
+    buffer = io.BytesIO()
+    with transfer.compress(buffer, compression, None) as writer:
+        writer.write(data)
+    return buffer.getvalue()
+
+
+def decompress_chunk(data: bytes, name: str) -> bytes:
+    for compression, extension in LOG_EXTENSIONS.items():
+        if compression is not None and name.endswith("." + extension):
+            with transfer.decompress(io.BytesIO(data), compression) as reader:
+                return reader.read()
+    return data
+
+
+class LogShipper:
+    """
+    Ship the log of an executor to a storage while a job runs.
+    The log is read from the last read offset every `interval` seconds and
+    buffered, and shipped as soon as `chunk_size` bytes are buffered, as chunks
+    split at line ends under `<job>/__logs__/`. The rest is shipped when the job
+    ends. The chunk names are kept in the job metadata entry `__log_chunks__`, so
+    that the log can be read back in order without the executor.
+    The logs of executors with several hosts are read host by host, so that the
+    stored log merges them chunk by chunk.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        executor: Executor,
+        job_id: str,
+        interval: float = 30.0,
+        chunk_size: int = 16 * transfer.MB,
+        compression: str | None = "gzip",
+    ):
+        if compression not in LOG_EXTENSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+
+        self.storage = storage
+        self.executor = executor
+        self.job_id = job_id
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.compression = compression
+
+        self._offsets: list[int] = []
+        self._buffers: list[bytes] = []
+        self._chunks: list[str] = []
+        self._stop = Event()
+
+    def ship_chunk(self, data: bytes):
+        name = get_log_chunk_name(len(self._chunks) + 1, self.compression)
+        key = f"{self.job_id}/{name}"
+        self.storage.set_blob(key, compress_chunk(data, self.compression))
+
+        chunks = self._chunks + [name]
+        self.storage.set_job_meta(self.job_id, {"__log_chunks__": json.dumps(chunks)})
+        self._chunks = chunks
+
+    def flush(self, final: bool = False):
+        """
+        Buffer the complete lines written since the last flush, or all data if
+        final, and ship the full chunks, or all of the buffer if final.
+        """
+        sources = self.executor.get_log_sources()
+        self._offsets += [0] * (len(sources) - len(self._offsets))
+        self._buffers += [b""] * (len(sources) - len(self._buffers))
+        for i, source in enumerate(sources):
+            self.read_source(i, source, final)
+            self.ship_buffer(i, final)
+
+    def read_source(self, index: int, source: Executor, final: bool):
+        while True:
+            data = source.read_logs(self._offsets[index], self.chunk_size)
+            if len(data) < self.chunk_size and not final:
+                # wait for the last line to be complete
+                data = data[: data.rfind(b"\n") + 1]
+            if not data:
+                return
+
+            self._buffers[index] += data
+            self._offsets[index] += len(data)
+            self.ship_buffer(index)
+
+    def ship_buffer(self, index: int, final: bool = False):
+        """Ship the buffered log of a source in chunks, and the rest of it if final"""
+        while len(self._buffers[index]) >= self.chunk_size or (
+            final and self._buffers[index]
+        ):
+            data = self._buffers[index][: self.chunk_size]
+            if len(data) == self.chunk_size and b"\n" in data:
+                data = data[: data.rindex(b"\n") + 1]
+            self.ship_chunk(data)
+            self._buffers[index] = self._buffers[index][len(data) :]
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # keep the job running, the next flush retries
+                print(f"[logs] shipping failed: {e}", flush=True)
+
+    @contextmanager
+    def ship(self):
+        """Ship the log in a background thread, and the rest of it on exit"""
+        thread = Thread(target=self.run, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            self._stop.set()
+            thread.join()
+            self.flush(final=True)
+
+
+def iter_stored_logs(storage: Storage, job_id: str, offset: int = 0) -> Iterator[bytes]:
+    """
+    Read the shipped log of a job chunk by chunk, starting at a byte offset.
+    :raises KeyError: If no log was shipped for the job.
+    """
+    entries = storage.get_job_meta(job_id, ["__log_chunks__"])
+    if "__log_chunks__" not in entries:
+        raise KeyError(f"No logs stored for job {job_id}")
+
+    for name in json.loads(entries["__log_chunks__"]):
+        data = decompress_chunk(storage.get_blob(f"{job_id}/{name}"), name)
+        if offset < len(data):
+            yield data[offset:]
+        offset = max(offset - len(data), 0)
@@ -1,9 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from threading import Lock
+from typing import Any
+import json
 import os
+import time
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from aeolos import Storage, Step
+from . import transfer
 
 
 class S3(Storage):
@@ -14,13 +21,40 @@ class S3(Storage):
         region: str | None = None,
         access_key: str | None = None,
         secret_key: str | None = None,
+        max_concurrency: int = 10,
+        multipart_chunksize: int = 8 * transfer.MB,
+        multipart_threshold: int = 8 * transfer.MB,
+        file_workers: int = 8,
+        meta_workers: int = 16,
+        python: str = "python3",
+        manifest: bool = False,
+        content_addressed: bool = False,
+        pack: str | None = None,
+        pack_level: int | None = None,
+        pack_chunk_size: int = 64 * transfer.MB,
+        delta: bool = False,
     ):
         self.bucket = bucket
         self.endpoint = endpoint
+        self.max_concurrency = max_concurrency
+        self.multipart_chunksize = multipart_chunksize
+        self.multipart_threshold = multipart_threshold
+        self.file_workers = file_workers
+        self.meta_workers = meta_workers
+        self.python = python
+        self.manifest = manifest
+        self.content_addressed = content_addressed
+        self.pack = pack
+        self.pack_level = pack_level
+        self.pack_chunk_size = pack_chunk_size
+        self.delta = delta
         self._region = region
         self._access_key = access_key
         self._secret_key = secret_key
 
+        self._client = None
+        self._client_lock = Lock()
+
     @contextmanager
     def setup(self):
         yield
@@ -46,40 +80,180 @@ class S3(Storage):
 
         return env
 
-    def get_command(self) -> list[str]:
-        cmd = ["aws", "s3"]
-        if self.endpoint is not None:
-            cmd += ["--endpoint-url", self.endpoint]
-        return cmd
+    def transfer(self, action: str, step: Step):
+        """Transfer a step directory with boto3"""
+        client = {"endpoint": self.endpoint, "region": self._region}
+        args: dict[str, Any] = {
+            "action": action,
+            "bucket": self.bucket,
+            "prefix": self.get_location(step),
+            "client": client,
+            "transfer": {
+                "max_concurrency": self.max_concurrency,
+                "multipart_chunksize": self.multipart_chunksize,
+                "multipart_threshold": self.multipart_threshold,
+            },
+            "file_workers": self.file_workers,
+            "delta": self.delta,
+        }
+        local_args = {
+            "client": client
+            | {"access_key": self._access_key, "secret_key": self._secret_key}
+        }
+        self.run_transfer(step, args, env=self.aws_credentials, local_args=local_args)
 
     def pull(self, step: Step):
-        s3_url = f"s3://{self.bucket}/{step.job_id}/{step.id}"
-        cmd = self.get_command() + ["cp", "--recursive", s3_url, "."]
-        self.command(cmd, env=self.aws_credentials, step=step)
+        self.transfer("pull", step)
+        self.record_access(step)
+
+    def record_access(self, step: Step):
+        # S3 does not record reads, keep the access time for garbage collection
+        self.set_meta(f"__access__/{self.get_location(step)}", str(time.time()))
 
     def push(self, step: Step):
-        s3_url = f"s3://{self.bucket}/{step.job_id}/{step.id}"
-        cmd = self.get_command() + ["cp", "--recursive", ".", s3_url]
-        self.command(cmd, env=self.aws_credentials, step=step)
+        self.transfer("push", step)
 
     def get_client(self):
-        return boto3.client(
-            "s3",
-            endpoint_url=self.endpoint,
-            region_name=self._region,
-            aws_access_key_id=self._access_key,
-            aws_secret_access_key=self._secret_key,
-        )
+        """Get the client, which is created once and shared between threads"""
+        with self._client_lock:
+            if self._client is None:
+                self._client = boto3.client(
+                    "s3",
+                    endpoint_url=self.endpoint,
+                    region_name=self._region,
+                    aws_access_key_id=self._access_key,
+                    aws_secret_access_key=self._secret_key,
+                    config=Config(max_pool_connections=self.meta_workers),
+                )
+            return self._client
 
-    def get_meta(self, key: str) -> str:
+    def get_blob(self, key: str) -> bytes:
         client = self.get_client()
         try:
             response = client.get_object(Bucket=self.bucket, Key=key)
-            return response["Body"].read().decode("utf-8")
+            return response["Body"].read()
         except ClientError as e:
             if e.response["Error"]["Code"] == "NoSuchKey":
-                raise KeyError(f"Metadata entry {key} does not exist")
+                raise KeyError(f"Entry {key} does not exist")
+            raise
+
+    def set_blob(self, key: str, data: bytes):
+        client = self.get_client()
+        client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def get_meta(self, key: str) -> str:
+        try:
+            return self.get_blob(key).decode("utf-8")
+        except KeyError:
+            raise KeyError(f"Metadata entry {key} does not exist")
 
     def set_meta(self, key: str, value: str):
+        self.set_blob(key, value.encode("utf-8"))
+
+    def get_meta_many(self, keys: list[str]) -> dict[str, str]:
+        def get(key: str) -> str | None:
+            try:
+                return self.get_meta(key)
+            except KeyError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.meta_workers) as pool:
+            values = pool.map(get, keys)
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def set_meta_many(self, entries: dict[str, str]):
+        def put(item: tuple[str, str]):
+            self.set_meta(*item)
+
+        with ThreadPoolExecutor(max_workers=self.meta_workers) as pool:
+            list(pool.map(put, entries.items()))
+
+    def read_manifest(self, job_id: str) -> tuple[dict[str, Any], str | None]:
+        client = self.get_client()
+        try:
+            response = client.get_object(
+                Bucket=self.bucket, Key=f"{job_id}/__manifest__.json"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return {}, None
+            raise
+        return json.loads(response["Body"].read()), response["ETag"]
+
+    def write_manifest(
+        self, job_id: str, manifest: dict[str, Any], version: str | None
+    ) -> bool:
+        if version is None:
+            condition = {"IfNoneMatch": "*"}
+        else:
+            condition = {"IfMatch": version}
+
+        client = self.get_client()
+        try:
+            client.put_object(
+                Bucket=self.bucket,
+                Key=f"{job_id}/__manifest__.json",
+                Body=json.dumps(manifest).encode("utf-8"),
+                **condition,
+            )
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("PreconditionFailed", "ConditionalRequestConflict"):
+                return False
+            raise
+        return True
+
+    def list_results(self) -> list[dict[str, Any]]:
+        """List the stored results, listing each top level prefix in parallel"""
         client = self.get_client()
-        client.put_object(Bucket=self.bucket, Key=key, Body=value.encode("utf-8"))
+        paginator = client.get_paginator("list_objects_v2")
+        prefixes = [
+            prefix["Prefix"]
+            for page in paginator.paginate(Bucket=self.bucket, Delimiter="/")
+            for prefix in page.get("CommonPrefixes", [])
+        ]
+
+        with ThreadPoolExecutor(max_workers=self.meta_workers) as pool:
+            listings = pool.map(
+                lambda prefix: transfer.list_objects(client, self.bucket, prefix),
+                prefixes,
+            )
+            objects = [obj for listing in listings for obj in listing]
+
+        results: dict[str, dict[str, Any]] = {}
+        accessed: dict[str, float] = {}
+        for obj in objects:
+            modified = obj["LastModified"].timestamp()
+            if obj["Key"].startswith("__access__/"):
+                accessed[obj["Key"][len("__access__/") :]] = modified
+                continue
+
+            location = self.get_result_location(obj["Key"])
+            if location is None:
+                continue
+            result = results.setdefault(
+                location, {"location": location, "size": 0, "last_access": 0.0}
+            )
+            result["size"] += obj["Size"]
+            result["last_access"] = max(result["last_access"], modified)
+
+        for location, result in results.items():
+            result["last_access"] = max(
+                result["last_access"], accessed.get(location, 0.0)
+            )
+        return list(results.values())
+
+    def delete_results(self, locations: list[str]):
+        """Delete stored results with batched DeleteObjects requests"""
+        client = self.get_client()
+        prefixes = [location + "/" for location in locations]
+        with ThreadPoolExecutor(max_workers=self.meta_workers) as pool:
+            listings = pool.map(
+                lambda prefix: transfer.list_objects(client, self.bucket, prefix),
+                prefixes,
+            )
+            keys = [obj["Key"] for listing in listings for obj in listing]
+
+        keys += locations
+        keys += [f"__access__/{location}" for location in locations]
+        transfer.delete_objects(client, self.bucket, keys)
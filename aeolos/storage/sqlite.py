@@ -0,0 +1,179 @@
+from pathlib import Path
+from threading import Lock
+from typing import Any
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    started REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated);
+CREATE TABLE IF NOT EXISTS steps (
+    job_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    state TEXT NOT NULL,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    bytes INTEGER,
+    PRIMARY KEY (job_id, name)
+);
+"""
+
+# keep queries below the default limit of host parameters
+BATCH_SIZE = 500
+
+
+class SQLiteIndex:
+    """
+    Metadata entries and the states of jobs and steps in a SQLite database.
+    The database is opened in WAL mode, so that readers do not block writers of
+    other processes. The connection is shared between threads.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._db: sqlite3.Connection | None = None
+        self._lock = Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def execute(self, sql: str, params: tuple | list = ()) -> list[tuple]:
+        with self._lock:
+            db = self.connect()
+            with db:
+                return db.execute(sql, params).fetchall()
+
+    def get_many(self, keys: list[str]) -> dict[str, str]:
+        values = {}
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i : i + BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.execute(
+                f"SELECT key, value FROM meta WHERE key IN ({placeholders})", batch
+            )
+            values.update(rows)
+        return values
+
+    def set_many(self, entries: dict[str, str]):
+        updated = time.time()
+        with self._lock:
+            db = self.connect()
+            with db:
+                db.executemany(
+                    """
+                    INSERT OR REPLACE INTO meta (key, value, updated)
+                    VALUES (?, ?, ?)
+                    """,
+                    [(key, value, updated) for key, value in entries.items()],
+                )
+
+    def list_meta(self, suffix: str) -> list[tuple[str, int, float]]:
+        """
+        List the keys ending with a suffix, with the size and update time of
+        their values.
+        """
+        return self.execute(
+            """
+            SELECT key, length(value), updated FROM meta
+            WHERE substr(key, -length(?)) = ?
+            """,
+            (suffix, suffix),
+        )
+
+    def delete_meta(self, locations: list[str]):
+        """Delete the entries of several locations and the entries below them"""
+        for location in locations:
+            self.execute(
+                "DELETE FROM meta WHERE key = ? OR substr(key, 1, ?) = ?",
+                (location, len(location) + 1, location + "/"),
+            )
+
+    def set_job_state(self, job_id: str, state: str):
+        now = time.time()
+        self.execute(
+            """
+            INSERT INTO jobs (job_id, state, started, updated) VALUES (?, ?, ?, ?)
+            ON CONFLICT (job_id) DO UPDATE SET
+                state = excluded.state,
+                started = CASE WHEN excluded.state = 'running'
+                    THEN excluded.started ELSE jobs.started END,
+                updated = excluded.updated
+            """,
+            (job_id, state, now, now),
+        )
+
+    def set_step_state(
+        self,
+        job_id: str,
+        name: str,
+        fingerprint: str,
+        state: str,
+        duration: float | None = None,
+        size: int | None = None,
+    ):
+        now = time.time()
+        started = now if state == "running" else None
+        finished = None if state == "running" else now
+        self.execute(
+            """
+            INSERT INTO steps
+                (job_id, name, fingerprint, state, started, finished, duration, bytes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (job_id, name) DO UPDATE SET
+                fingerprint = excluded.fingerprint,
+                state = excluded.state,
+                started = coalesce(excluded.started, steps.started),
+                finished = excluded.finished,
+                duration = excluded.duration,
+                bytes = excluded.bytes
+            """,
+            (job_id, name, fingerprint, state, started, finished, duration, size),
+        )
+        self.execute("UPDATE jobs SET updated = ? WHERE job_id = ?", (now, job_id))
+
+    def list_jobs(
+        self, state: str | None = None, since: float | None = None
+    ) -> list[dict[str, Any]]:
+        """List jobs with their step counts, most recently updated first"""
+        conditions, params = [], []
+        if state is not None:
+            conditions.append("jobs.state = ?")
+            params.append(state)
+        if since is not None:
+            conditions.append("jobs.updated >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        rows = self.execute(
+            f"""
+            SELECT jobs.job_id, jobs.state, jobs.started, jobs.updated,
+                count(steps.name), count(CASE WHEN steps.state = 'done' THEN 1 END),
+                coalesce(sum(steps.bytes), 0)
+            FROM jobs LEFT JOIN steps ON steps.job_id = jobs.job_id
+            {where}
+            GROUP BY jobs.job_id
+            ORDER BY jobs.updated DESC
+            """,
+            params,
+        )
+        keys = ("id", "state", "started", "updated", "steps", "done", "bytes")
+        return [dict(zip(keys, row)) for row in rows]
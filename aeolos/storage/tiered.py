@@ -0,0 +1,176 @@
+from contextlib import contextmanager
+from pathlib import Path
+from secrets import token_hex
+from typing import Any
+import os
+import shutil
+
+from .base import Storage
+from .local import LINK_MODES, link_tree
+
+from aeolos import Step
+from aeolos.utils import ConfigurableObject
+
+GB = 1024 * 1024 * 1024
+
+
+class Tiered(Storage):
+    """
+    A storage with a local cache in front of another storage.
+    Results are cached by fingerprint, so pulls of a step that was pulled or pushed
+    on the same host before are served from the cache. The cache is bounded by
+    `cache_size` bytes, evicting the least recently used results.
+    Caching requires the executor workdir to be on this host, other executors pull
+    from and push to the wrapped storage directly.
+    """
+
+    def __init__(
+        self,
+        storage: dict[str, Any],
+        cache_path: str,
+        cache_size: int = 10 * GB,
+        link_mode: str = "auto",
+    ):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Link mode must be one of {', '.join(LINK_MODES)}")
+
+        self.storage = storage
+        self.cache_path = Path(cache_path)
+        self.cache_size = cache_size
+        self.link_mode = link_mode
+        self._storage: Storage = ConfigurableObject.load_dict(dict(storage))
+
+    @contextmanager
+    def setup(self):
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        with self._storage.in_executor(self.executor):
+            yield
+
+    @property
+    def manifest(self) -> bool:
+        return self._storage.manifest
+
+    def get_entry(self, step: Step) -> Path:
+        return self.cache_path / step.sha256()
+
+    def pull(self, step: Step):
+        local_path = self.executor.get_local_path(step)
+        if local_path is None:
+            self._storage.pull(step)
+            return
+
+        entry = self.get_entry(step)
+        if entry.is_dir():
+            os.utime(entry)
+            self._storage.record_access(step)
+            link_tree(entry, local_path, step, self.link_mode)
+            return
+
+        self._storage.pull(step)
+        self.add(step, local_path)
+
+    def push(self, step: Step):
+        self._storage.push(step)
+
+        local_path = self.executor.get_local_path(step)
+        if local_path is not None:
+            self.add(step, local_path)
+
+    def add(self, step: Step, local_path: Path):
+        """Add the result of a step to the cache and evict old results"""
+        entry = self.get_entry(step)
+        if entry.exists():
+            os.utime(entry)
+            return
+
+        tmp_entry = self.cache_path / f".{entry.name}.{token_hex(4)}"
+        link_tree(local_path, tmp_entry, step, self.link_mode)
+        tmp_entry.mkdir(exist_ok=True)
+        try:
+            tmp_entry.rename(entry)
+        except OSError:
+            # added concurrently
+            shutil.rmtree(tmp_entry)
+
+        self.evict()
+
+    @staticmethod
+    def get_size(path: Path) -> int:
+        size = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+        return size
+
+    def evict(self):
+        """Remove the least recently used results until the cache fits its size"""
+        entries = [
+            entry
+            for entry in self.cache_path.iterdir()
+            if entry.is_dir() and not entry.name.startswith(".")
+        ]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        sizes = {entry: self.get_size(entry) for entry in entries}
+
+        total = sum(sizes.values())
+        for entry in entries:
+            if total <= self.cache_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= sizes[entry]
+
+    def get_location(self, step: Step) -> str:
+        return self._storage.get_location(step)
+
+    def record_access(self, step: Step):
+        self._storage.record_access(step)
+
+    def get_meta(self, key: str) -> str:
+        return self._storage.get_meta(key)
+
+    def set_meta(self, key: str, value: str):
+        self._storage.set_meta(key, value)
+
+    def get_blob(self, key: str) -> bytes:
+        return self._storage.get_blob(key)
+
+    def set_blob(self, key: str, data: bytes):
+        self._storage.set_blob(key, data)
+
+    def get_meta_many(self, keys: list[str]) -> dict[str, str]:
+        return self._storage.get_meta_many(keys)
+
+    def set_meta_many(self, entries: dict[str, str]):
+        self._storage.set_meta_many(entries)
+
+    def get_job_meta(self, job_id: str, keys: list[str]) -> dict[str, str]:
+        return self._storage.get_job_meta(job_id, keys)
+
+    def set_job_meta(self, job_id: str, entries: dict[str, str]):
+        self._storage.set_job_meta(job_id, entries)
+
+    def is_done_many(self, steps: list[Step]) -> list[bool]:
+        return self._storage.is_done_many(steps)
+
+    def mark_done(self, step: Step):
+        self._storage.mark_done(step)
+
+    def list_results(self) -> list[dict[str, Any]]:
+        return self._storage.list_results()
+
+    def delete_results(self, locations: list[str]):
+        self._storage.delete_results(locations)
+
+    def drop_job_meta(self, job_id: str, prefixes: list[str]):
+        self._storage.drop_job_meta(job_id, prefixes)
+
+    def set_job_state(self, job_id: str, state: str):
+        self._storage.set_job_state(job_id, state)
+
+    def set_step_state(self, step: Step, state: str, duration: float | None = None):
+        self._storage.set_step_state(step, state, duration)
+
+    def list_jobs(
+        self, state: str | None = None, since: float | None = None
+    ) -> list[dict[str, Any]]:
+        return self._storage.list_jobs(state, since)
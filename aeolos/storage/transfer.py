@@ -0,0 +1,766 @@
+"""
+Transfer step directories from and to S3 using boto3 managed transfers.
+
+This module only depends on boto3 and the standard library, so that it can be
+uploaded to and run on executors without aeolos installed:
+
+    python3 ~/.cache/aeolos/transfer_<hash>.py <json arguments>
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from threading import BoundedSemaphore
+import gzip
+import hashlib
+import io
+import json
+import re
+import sys
+import tarfile
+import time
+from typing import IO, Any, Callable
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+MB = 1024 * 1024
+PACK_DIR = "__pack__"
+INDEX = "__index__.json"
+PACK_EXTENSIONS = {"gzip": "tar.gz", "zstd": "tar.zst"}
+
+
+def glob_to_regex(pattern: str) -> str:
+    """
+    Translate a glob pattern for paths relative to a step directory into a regex.
+    `*` and `?` do not match `/`, `**` matches across directories, and a pattern
+    matching a directory also matches everything inside it.
+    """
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex.rstrip("/") + "(?:/.*)?"
+
+
+def is_selected(
+    path: str,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> bool:
+    """Check if a relative path matches the outputs and none of the exclude patterns"""
+    if outputs is not None:
+        if not any(re.fullmatch(glob_to_regex(p), path) for p in outputs):
+            return False
+    if exclude is not None:
+        if any(re.fullmatch(glob_to_regex(p), path) for p in exclude):
+            return False
+    return True
+
+
+def select_files(
+    directory: Path,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> list[Path]:
+    """List the files in a directory that are selected by the patterns"""
+    return [
+        path
+        for path in sorted(directory.rglob("*"))
+        if path.is_file()
+        and is_selected(path.relative_to(directory).as_posix(), outputs, exclude)
+    ]
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while block := f.read(MB):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def index_files(
+    directory: Path, files: list[Path], workers: int = 8
+) -> dict[str, dict[str, Any]]:
+    """Get the size and content hash of files, keyed by their relative path"""
+
+    def index_file(path: Path) -> dict[str, Any]:
+        return {"size": path.stat().st_size, "sha256": hash_file(path)}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        entries = pool.map(index_file, files)
+    names = [path.relative_to(directory).as_posix() for path in files]
+    return dict(zip(names, entries))
+
+
+def get_chunk_name(index: int, compression: str) -> str:
+    return f"{PACK_DIR}/{index:05d}.{PACK_EXTENSIONS[compression]}"
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the zstandard package")
+    return zstandard
+
+
+class ChunkWriter(io.RawIOBase):
+    """
+    A stream split into chunks of a fixed size.
+    Each chunk is passed to `write_chunk(index, data)` on a thread pool, with at
+    most `workers` chunks in flight.
+    """
+
+    def __init__(
+        self,
+        write_chunk: Callable[[int, bytes], None],
+        chunk_size: int,
+        workers: int = 4,
+    ):
+        self._write_chunk = write_chunk
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = BoundedSemaphore(workers)
+        self._futures: list[Future] = []
+        self.chunks = 0
+        self.bytes = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            self._submit(bytes(self._buffer[: self._chunk_size]))
+            del self._buffer[: self._chunk_size]
+        return len(data)
+
+    def _submit(self, data: bytes):
+        self._slots.acquire()
+        future = self._pool.submit(self._write_chunk, self.chunks, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        self.chunks += 1
+        self.bytes += len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if self._buffer or self.chunks == 0:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        self._pool.shutdown()
+        for future in self._futures:
+            future.result()
+        super().close()
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    A stream concatenated from chunks returned by `read_chunk(index)`.
+    Up to `workers` chunks are fetched ahead on a thread pool.
+    """
+
+    def __init__(
+        self,
+        read_chunk: Callable[[int], bytes],
+        chunks: int,
+        workers: int = 4,
+    ):
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._read_chunk = read_chunk
+        self._futures = [
+            self._pool.submit(read_chunk, i) for i in range(min(workers, chunks))
+        ]
+        self._chunks = chunks
+        self._next = len(self._futures)
+        self._buffer = memoryview(b"")
+        self.bytes = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            if not self._futures:
+                return 0
+            data = self._futures.pop(0).result()
+            if self._next < self._chunks:
+                self._futures.append(self._pool.submit(self._read_chunk, self._next))
+                self._next += 1
+            self._buffer = memoryview(data)
+            self.bytes += len(data)
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+        super().close()
+
+
+def compress(fileobj: IO[bytes], compression: str, level: int | None) -> IO[bytes]:
+    if compression == "gzip":
+        return gzip.GzipFile(
+            fileobj=fileobj, mode="wb", compresslevel=level or 6, mtime=0
+        )
+    elif compression == "zstd":
+        compressor = import_zstandard().ZstdCompressor(level=level or 3)
+        return compressor.stream_writer(fileobj, closefd=False)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def decompress(fileobj: IO[bytes], compression: str) -> IO[bytes]:
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    elif compression == "zstd":
+        decompressor = import_zstandard().ZstdDecompressor()
+        return decompressor.stream_reader(fileobj, closefd=False)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def pack(
+    directory: str | Path,
+    write_chunk: Callable[[int, bytes], None],
+    compression: str = "gzip",
+    level: int | None = None,
+    chunk_size: int = 64 * MB,
+    workers: int = 4,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """
+    Stream the selected files of a directory into a compressed tar archive,
+    split into chunks that are written concurrently.
+    """
+    start = time.monotonic()
+    directory = Path(directory)
+    files = select_files(directory, outputs, exclude)
+
+    writer = ChunkWriter(write_chunk, chunk_size, workers)
+    with compress(writer, compression, level) as stream:
+        with tarfile.open(fileobj=stream, mode="w|") as tar:
+            for path in files:
+                arcname = path.relative_to(directory).as_posix()
+                tar.add(path, arcname=arcname, recursive=False)
+    writer.close()
+
+    return {
+        "files": len(files),
+        "names": [path.relative_to(directory).as_posix() for path in files],
+        "chunks": writer.chunks,
+        "bytes": writer.bytes,
+        "seconds": time.monotonic() - start,
+    }
+
+
+def unpack(
+    directory: str | Path,
+    read_chunk: Callable[[int], bytes],
+    chunks: int,
+    compression: str = "gzip",
+    workers: int = 4,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """Stream chunks of a compressed tar archive and extract the selected files"""
+    start = time.monotonic()
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    # extraction filters are available from python 3.11.4
+    extract_args = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+    files = 0
+    reader = ChunkReader(read_chunk, chunks, workers)
+    with decompress(io.BufferedReader(reader), compression) as stream:
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                if is_selected(member.name, outputs, exclude):
+                    tar.extract(member, directory, **extract_args)
+                    files += 1
+    reader.close()
+
+    return {
+        "files": files,
+        "bytes": reader.bytes,
+        "seconds": time.monotonic() - start,
+    }
+
+
+def get_client(
+    endpoint: str | None = None,
+    region: str | None = None,
+    access_key: str | None = None,
+    secret_key: str | None = None,
+    max_pool_connections: int = 10,
+):
+    return boto3.client(
+        "s3",
+        endpoint_url=endpoint,
+        region_name=region,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        config=Config(max_pool_connections=max_pool_connections),
+    )
+
+
+def get_transfer_config(
+    max_concurrency: int = 10,
+    multipart_chunksize: int = 8 * MB,
+    multipart_threshold: int = 8 * MB,
+) -> TransferConfig:
+    return TransferConfig(
+        max_concurrency=max_concurrency,
+        multipart_chunksize=multipart_chunksize,
+        multipart_threshold=multipart_threshold,
+    )
+
+
+def report(action: str, location: str, stats: dict[str, Any]):
+    size = stats["bytes"] / MB
+    seconds = stats["seconds"]
+    throughput = size / seconds if seconds > 0 else 0.0
+    print(
+        f"[{action}] {location}: {stats['files']} files, "
+        f"{size:.1f} MB in {seconds:.1f} s ({throughput:.1f} MB/s)",
+        flush=True,
+    )
+
+
+def push(
+    client,
+    directory: str | Path,
+    bucket: str,
+    prefix: str,
+    transfer_config: TransferConfig,
+    file_workers: int = 8,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """
+    Upload the selected files in a directory below a prefix.
+    If outputs or exclude patterns are given, the list of uploaded files is stored
+    as `<prefix>/__files__`.
+    """
+    start = time.monotonic()
+    directory = Path(directory)
+    files = select_files(directory, outputs, exclude)
+
+    def upload(path: Path) -> int:
+        key = prefix + "/" + path.relative_to(directory).as_posix()
+        client.upload_file(str(path), bucket, key, Config=transfer_config)
+        return path.stat().st_size
+
+    with ThreadPoolExecutor(max_workers=file_workers) as pool:
+        sizes = list(pool.map(upload, files))
+
+    if outputs is not None or exclude is not None:
+        names = [path.relative_to(directory).as_posix() for path in files]
+        client.put_object(
+            Bucket=bucket,
+            Key=prefix + "/__files__",
+            Body=json.dumps(names).encode("utf-8"),
+        )
+
+    return {
+        "files": len(files),
+        "bytes": sum(sizes),
+        "seconds": time.monotonic() - start,
+    }
+
+
+def list_objects(client, bucket: str, prefix: str) -> list[dict[str, Any]]:
+    objects = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects += page.get("Contents", [])
+    return objects
+
+
+def delete_objects(client, bucket: str, keys: list[str]):
+    for i in range(0, len(keys), 1000):
+        objects = [{"Key": key} for key in keys[i : i + 1000]]
+        client.delete_objects(Bucket=bucket, Delete={"Objects": objects})
+
+
+def pull(
+    client,
+    directory: str | Path,
+    bucket: str,
+    prefix: str,
+    transfer_config: TransferConfig,
+    file_workers: int = 8,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """Download the selected objects below a prefix into a directory"""
+    start = time.monotonic()
+    directory = Path(directory)
+
+    objects = [
+        obj
+        for obj in list_objects(client, bucket, prefix + "/")
+        if is_selected(obj["Key"][len(prefix) + 1 :], outputs, exclude)
+    ]
+
+    def download(obj: dict[str, Any]) -> int:
+        path = directory / obj["Key"][len(prefix) + 1 :]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        client.download_file(bucket, obj["Key"], str(path), Config=transfer_config)
+        return obj["Size"]
+
+    with ThreadPoolExecutor(max_workers=file_workers) as pool:
+        sizes = list(pool.map(download, objects))
+
+    return {
+        "files": len(objects),
+        "bytes": sum(sizes),
+        "seconds": time.monotonic() - start,
+    }
+
+
+def read_index(client, bucket: str, prefix: str) -> dict[str, dict[str, Any]] | None:
+    try:
+        response = client.get_object(Bucket=bucket, Key=f"{prefix}/{INDEX}")
+    except client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response["Body"].read())
+
+
+def push_delta(
+    client,
+    directory: str | Path,
+    bucket: str,
+    prefix: str,
+    transfer_config: TransferConfig,
+    file_workers: int = 8,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """
+    Upload the selected files in a directory that differ from the stored index,
+    delete the ones that were removed, and store the new index.
+    """
+    start = time.monotonic()
+    directory = Path(directory)
+    files = select_files(directory, outputs, exclude)
+    index = index_files(directory, files, file_workers)
+    stored = read_index(client, bucket, prefix) or {}
+
+    changed = [name for name, entry in index.items() if stored.get(name) != entry]
+    removed = [f"{prefix}/{name}" for name in stored if name not in index]
+
+    def upload(name: str) -> int:
+        path = directory / name
+        key = f"{prefix}/{name}"
+        client.upload_file(str(path), bucket, key, Config=transfer_config)
+        return index[name]["size"]
+
+    with ThreadPoolExecutor(max_workers=file_workers) as pool:
+        sizes = list(pool.map(upload, changed))
+    delete_objects(client, bucket, removed)
+
+    client.put_object(
+        Bucket=bucket, Key=f"{prefix}/{INDEX}", Body=json.dumps(index).encode("utf-8")
+    )
+    if outputs is not None or exclude is not None:
+        client.put_object(
+            Bucket=bucket,
+            Key=prefix + "/__files__",
+            Body=json.dumps(list(index)).encode("utf-8"),
+        )
+
+    return {
+        "files": len(changed),
+        "deleted": len(removed),
+        "bytes": sum(sizes),
+        "seconds": time.monotonic() - start,
+    }
+
+
+def pull_delta(
+    client,
+    directory: str | Path,
+    bucket: str,
+    prefix: str,
+    transfer_config: TransferConfig,
+    file_workers: int = 8,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """
+    Download the selected files of the stored index that are missing or differ in
+    the directory. Falls back to a full pull if no index is stored.
+    """
+    stored = read_index(client, bucket, prefix)
+    if stored is None:
+        return pull(
+            client,
+            directory,
+            bucket,
+            prefix,
+            transfer_config,
+            file_workers=file_workers,
+            outputs=outputs,
+            exclude=exclude,
+        )
+
+    start = time.monotonic()
+    directory = Path(directory)
+    stored = {
+        name: entry
+        for name, entry in stored.items()
+        if is_selected(name, outputs, exclude)
+    }
+    present = [
+        directory / name
+        for name, entry in stored.items()
+        if (directory / name).is_file()
+        and (directory / name).stat().st_size == entry["size"]
+    ]
+    index = index_files(directory, present, file_workers)
+    changed = [name for name, entry in stored.items() if index.get(name) != entry]
+
+    def download(name: str) -> int:
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        key = f"{prefix}/{name}"
+        client.download_file(bucket, key, str(path), Config=transfer_config)
+        return stored[name]["size"]
+
+    with ThreadPoolExecutor(max_workers=file_workers) as pool:
+        sizes = list(pool.map(download, changed))
+
+    return {
+        "files": len(changed),
+        "bytes": sum(sizes),
+        "seconds": time.monotonic() - start,
+    }
+
+
+def get_pack_compression(names: list[str]) -> str:
+    """Get the compression of a packed archive from the names of its chunks"""
+    compressions = {
+        compression
+        for name in names
+        for compression, extension in PACK_EXTENSIONS.items()
+        if name.endswith("." + extension)
+    }
+    if len(compressions) != 1:
+        raise ValueError(f"Invalid packed archive: {', '.join(names)}")
+    return compressions.pop()
+
+
+def push_packed(
+    client,
+    directory: str | Path,
+    bucket: str,
+    prefix: str,
+    pack_args: dict[str, Any],
+    file_workers: int = 8,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """Upload the selected files in a directory as chunks of a packed archive"""
+    compression = pack_args["compression"]
+
+    def write_chunk(index: int, data: bytes):
+        key = f"{prefix}/{get_chunk_name(index, compression)}"
+        client.put_object(Bucket=bucket, Key=key, Body=data)
+
+    stats = pack(
+        directory,
+        write_chunk,
+        **pack_args,
+        workers=file_workers,
+        outputs=outputs,
+        exclude=exclude,
+    )
+
+    written = {
+        f"{prefix}/{get_chunk_name(i, compression)}" for i in range(stats["chunks"])
+    }
+    stale = [
+        obj["Key"]
+        for obj in list_objects(client, bucket, f"{prefix}/{PACK_DIR}/")
+        if obj["Key"] not in written
+    ]
+    delete_objects(client, bucket, stale)
+
+    if outputs is not None or exclude is not None:
+        client.put_object(
+            Bucket=bucket,
+            Key=prefix + "/__files__",
+            Body=json.dumps(stats["names"]).encode("utf-8"),
+        )
+    return stats
+
+
+def pull_packed(
+    client,
+    directory: str | Path,
+    bucket: str,
+    prefix: str,
+    file_workers: int = 8,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """Download the chunks of a packed archive and extract the selected files"""
+    keys = sorted(
+        obj["Key"] for obj in list_objects(client, bucket, f"{prefix}/{PACK_DIR}/")
+    )
+    if not keys:
+        return {"files": 0, "bytes": 0, "seconds": 0.0}
+
+    def read_chunk(index: int) -> bytes:
+        return client.get_object(Bucket=bucket, Key=keys[index])["Body"].read()
+
+    return unpack(
+        directory,
+        read_chunk,
+        len(keys),
+        compression=get_pack_compression(keys),
+        workers=file_workers,
+        outputs=outputs,
+        exclude=exclude,
+    )
+
+
+def pack_to_directory(
+    directory: str | Path,
+    target: str | Path,
+    pack_args: dict[str, Any],
+    file_workers: int = 8,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """Write the selected files in a directory as chunks of a packed archive"""
+    compression = pack_args["compression"]
+    pack_dir = Path(target) / PACK_DIR
+    pack_dir.mkdir(parents=True, exist_ok=True)
+
+    def write_chunk(index: int, data: bytes):
+        (Path(target) / get_chunk_name(index, compression)).write_bytes(data)
+
+    stats = pack(
+        directory,
+        write_chunk,
+        **pack_args,
+        workers=file_workers,
+        outputs=outputs,
+        exclude=exclude,
+    )
+
+    written = {get_chunk_name(i, compression) for i in range(stats["chunks"])}
+    for path in pack_dir.iterdir():
+        if f"{PACK_DIR}/{path.name}" not in written:
+            path.unlink()
+
+    if outputs is not None or exclude is not None:
+        (Path(target) / "__files__").write_text(json.dumps(stats["names"]))
+    return stats
+
+
+def unpack_from_directory(
+    directory: str | Path,
+    target: str | Path,
+    file_workers: int = 8,
+    outputs: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> dict[str, Any]:
+    """Read the chunks of a packed archive and extract the selected files"""
+    pack_dir = Path(target) / PACK_DIR
+    paths = sorted(pack_dir.iterdir()) if pack_dir.exists() else []
+    if not paths:
+        return {"files": 0, "bytes": 0, "seconds": 0.0}
+
+    return unpack(
+        directory,
+        lambda index: paths[index].read_bytes(),
+        len(paths),
+        compression=get_pack_compression([path.name for path in paths]),
+        workers=file_workers,
+        outputs=outputs,
+        exclude=exclude,
+    )
+
+
+def main(args: dict[str, Any]):
+    """
+    Run a transfer described by a dictionary.
+    The actions push and pull transfer between the directory and an S3 prefix,
+    pack and unpack between the directory and a target directory. All actions take
+    the keys directory, file_workers, outputs, exclude and pack, which holds the
+    arguments of `pack` to transfer a packed archive. S3 transfers additionally take
+    bucket, prefix, client, transfer and delta, to only transfer changed files, and
+    take the credentials from the environment. Local transfers take the key target.
+    """
+    action = args["action"]
+    file_workers = args["file_workers"]
+    selection = {"outputs": args["outputs"], "exclude": args["exclude"]}
+
+    if action == "pack":
+        stats = pack_to_directory(
+            args["directory"],
+            args["target"],
+            args["pack"],
+            file_workers=file_workers,
+            **selection,
+        )
+        report(action, args["target"], stats)
+        return
+    elif action == "unpack":
+        stats = unpack_from_directory(
+            args["directory"], args["target"], file_workers=file_workers, **selection
+        )
+        report(action, args["target"], stats)
+        return
+
+    transfer_config = get_transfer_config(**args["transfer"])
+    client = get_client(
+        **args["client"],
+        max_pool_connections=file_workers * transfer_config.max_request_concurrency,
+    )
+    location = (client, args["directory"], args["bucket"], args["prefix"])
+
+    if action == "push" and args["pack"] is not None:
+        stats = push_packed(
+            *location, args["pack"], file_workers=file_workers, **selection
+        )
+    elif action == "pull" and args["pack"] is not None:
+        stats = pull_packed(*location, file_workers=file_workers, **selection)
+    elif args.get("delta"):
+        transfer = {"push": push_delta, "pull": pull_delta}[action]
+        stats = transfer(
+            *location, transfer_config, file_workers=file_workers, **selection
+        )
+    else:
+        transfer = {"push": push, "pull": pull}[action]
+        stats = transfer(
+            *location, transfer_config, file_workers=file_workers, **selection
+        )
+    report(action, args["prefix"], stats)
+
+
+if __name__ == "__main__":
+    main(json.loads(sys.argv[1]))
@@ -1,6 +1,9 @@
-from dataclasses import dataclass
-from hashlib import sha256
+from dataclasses import dataclass, field
+from glob import glob
+from hashlib import file_digest, sha256
+from pathlib import Path
 from typing import Any, Iterator
+import json
 
 
 @dataclass
@@ -14,12 +17,45 @@ class Stage:
 
     id: str
     command: str
+    depends_on: list[str] | None = field(default=None, kw_only=True)
+    shards: int | list[dict[str, Any]] | None = field(default=None, kw_only=True)
+    gather: str | None = field(default=None, kw_only=True)
+    inputs: list[str] | None = field(default=None, kw_only=True)
+    outputs: list[str] | None = field(default=None, kw_only=True)
+    exclude: list[str] | None = field(default=None, kw_only=True)
 
     def __post_init__(self):
         if not self.id.isidentifier():
             raise ValueError(
                 f"Stage id must resemble valid pyhon identifier: {self.id}"
             )
+        if isinstance(self.shards, int) and self.shards < 1:
+            raise ValueError(f"Stage {self.id} must have at least one shard")
+        if isinstance(self.shards, list) and not self.shards:
+            raise ValueError(f"Stage {self.id} must have at least one shard")
+
+    @property
+    def num_shards(self) -> int:
+        if self.shards is None:
+            return 0
+        if isinstance(self.shards, int):
+            return self.shards
+        return len(self.shards)
+
+    def inputs_sha256(self) -> str:
+        """Hash the paths and contents of the files matching the declared inputs"""
+        if not self.inputs:
+            return ""
+
+        paths = {
+            Path(p) for pattern in self.inputs for p in glob(pattern, recursive=True)
+        }
+        digest = sha256()
+        for path in sorted(p for p in paths if p.is_file()):
+            with path.open("rb") as f:
+                file_sha256 = file_digest(f, "sha256").hexdigest()
+            digest.update(f"{path.as_posix()}:{file_sha256}\n".encode())
+        return digest.hexdigest()
 
 
 @dataclass
@@ -28,14 +64,49 @@ class Step(Stage):
 
     job_id: str
     config: dict[str, Any]
+    shard: int | None = field(default=None, kw_only=True)
+    upstream: list[str] = field(default_factory=list, kw_only=True)
+    """Fingerprints of the steps this step depends on"""
+    inputs_hash: str = field(default="", kw_only=True)
+    """Hash of the declared input files"""
+
+    @property
+    def name(self) -> str:
+        """
+        Unique name of the step within its job.
+        Shards are named `<stage>__shard_<k>`, so that their workdirs are siblings of
+        the stage workdir and not part of the result of the gather step.
+        """
+        if self.shard is None:
+            return self.id
+        return f"{self.id}__shard_{self.shard}"
+
+    @property
+    def path(self) -> str:
+        """Path of the step relative to the executor or storage root"""
+        return f"{self.job_id}/{self.name}"
 
     @classmethod
     def from_stage(cls, stage: Stage, **kwargs) -> "Step":
-        return cls(**vars(stage), **kwargs)
+        return cls(**(vars(stage) | kwargs))
 
     def sha256(self) -> str:
-        data = "\n".join(k + ":" + str(self.config[k]) for k in sorted(self.config))
-        data = self.id + "\n" + self.command + "\n" + data
+        """
+        Fingerprint of the step and, through their fingerprints, of all steps it
+        depends on. The job id is left out, so that equal steps of different jobs
+        share a fingerprint.
+        """
+        data = {
+            "id": self.id,
+            "command": self.command,
+            "config": self.config,
+            "upstream": self.upstream,
+            "inputs": self.inputs_hash,
+        }
+        if self.outputs is not None or self.exclude is not None:
+            data["outputs"] = self.outputs
+            data["exclude"] = self.exclude
+        data = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
         return sha256(data.encode()).hexdigest()
 
     def format_command(self):
@@ -44,7 +115,7 @@ class Step(Stage):
 
 @dataclass
 class Task:
-    """A sequence of stages"""
+    """A graph of stages"""
 
     stages: list[Stage]
 
@@ -53,9 +124,53 @@ class Task:
         if len(stage_ids) != len(self.stages):
             raise ValueError("Duplicate stage id")
 
+        for stage in self.stages:
+            unknown = set(self.dependencies(stage)) - stage_ids
+            if unknown:
+                raise ValueError(
+                    f"Stage {stage.id} depends on unknown stages: "
+                    + ", ".join(sorted(unknown))
+                )
+
+        self.ordered()
+
     def __iter__(self) -> Iterator[Stage]:
         return iter(self.stages)
 
+    def dependencies(self, stage: Stage) -> list[str]:
+        """
+        Get the ids of the stages a stage depends on.
+        Stages without `depends_on` depend on the preceding stage.
+        """
+        if stage.depends_on is not None:
+            return list(stage.depends_on)
+
+        index = next(i for i, other in enumerate(self.stages) if other.id == stage.id)
+        if index == 0:
+            return []
+        return [self.stages[index - 1].id]
+
+    def ordered(self) -> list[Stage]:
+        """
+        Get the stages in topological order.
+        :raises ValueError: If the dependencies contain a cycle.
+        """
+        ordered = []
+        done = set()
+        pending = list(self.stages)
+        while pending:
+            ready = [s for s in pending if done.issuperset(self.dependencies(s))]
+            if not ready:
+                ids = ", ".join(stage.id for stage in pending)
+                raise ValueError(f"Cyclic dependency between stages: {ids}")
+
+            for stage in ready:
+                ordered.append(stage)
+                done.add(stage.id)
+                pending.remove(stage)
+
+        return ordered
+
 
 @dataclass
 class Job(Task):
@@ -63,22 +178,85 @@ class Job(Task):
 
     id: str
     config: dict[str, dict[str, Any]]
+    _steps: list[Step] | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     def from_task(self, task: Task, **kwargs) -> "Job":
         return Job(**vars(task), **kwargs)
 
     def __iter__(self) -> Iterator[Step]:
-        for stage in self.stages:
-            config = self.config.get(stage.id, {})
-            yield Step.from_stage(stage, job_id=self.id, config=config)
+        return iter(self.steps)
+
+    @property
+    def steps(self) -> list[Step]:
+        """
+        The steps of all stages.
+        They are created once in topological order, so that each step can include
+        the fingerprints of the steps it depends on.
+        """
+        if self._steps is None:
+            steps: dict[str, list[Step]] = {}
+            for stage in self.ordered():
+                upstream = [steps[dep][-1].sha256() for dep in self.dependencies(stage)]
+                steps[stage.id] = self.get_steps(stage, upstream)
+            self._steps = [step for stage in self.stages for step in steps[stage.id]]
+        return self._steps
 
     def __getitem__(self, k: str | int) -> Step:
         if isinstance(k, int):
-            stage = self.stages[k]
+            stage_id = self.stages[k].id
+            return next(step for step in reversed(self.steps) if step.id == stage_id)
         elif isinstance(k, str):
-            stage = next(stage for stage in self.stages if stage.id == k)
+            return next(step for step in self if step.name == k)
         else:
             raise TypeError(f"Invalid index type: {k}: {type(k)}")
 
+    def get_steps(self, stage: Stage, upstream: list[str]) -> list[Step]:
+        """
+        Get the steps of a stage, given the fingerprints of the stages it depends on.
+        A sharded stage expands into one step per shard, followed by a gather step
+        that depends on all shards and runs the `gather` command, if any.
+        """
         config = self.config.get(stage.id, {})
-        return Step.from_stage(stage, job_id=self.id, config=config)
+        depends_on = self.dependencies(stage)
+        inputs_hash = stage.inputs_sha256()
+        if stage.shards is None:
+            return [
+                Step.from_stage(
+                    stage,
+                    job_id=self.id,
+                    config=config,
+                    depends_on=depends_on,
+                    upstream=upstream,
+                    inputs_hash=inputs_hash,
+                )
+            ]
+
+        num_shards = stage.num_shards
+        shards = []
+        for k in range(num_shards):
+            shard_config = config | {"shard": k, "num_shards": num_shards}
+            if isinstance(stage.shards, list):
+                shard_config |= stage.shards[k]
+
+            shard = Step.from_stage(
+                stage,
+                job_id=self.id,
+                config=shard_config,
+                depends_on=depends_on,
+                upstream=upstream,
+                inputs_hash=inputs_hash,
+                shard=k,
+            )
+            shards.append(shard)
+
+        gather = Step.from_stage(
+            stage,
+            command=stage.gather or "",
+            job_id=self.id,
+            config=config | {"num_shards": num_shards},
+            depends_on=[shard.name for shard in shards],
+            upstream=[shard.sha256() for shard in shards],
+        )
+        return shards + [gather]
@@ -1,7 +1,10 @@
 from typer.testing import CliRunner
+import json
 
 from aeolos import AeolosContext
 from aeolos.cli.cli import read_configs, app, ctx
+from aeolos.storage.local import Local as LocalStorage
+from aeolos import Step
 
 
 def test_read_context(context):
@@ -20,3 +23,48 @@ def test_cli(context):
     runner = CliRunner()
     runner.invoke(app, ["-j", json, "test"], catch_exceptions=True)
     runner.invoke(app, ["test", "-j", json], catch_exceptions=True)
+
+
+def test_list_not_supported(context):
+    result = CliRunner().invoke(app, ["-j", context.as_json(), "list"])
+    assert result.exit_code == 1
+    assert "not supported" in result.output
+
+
+def test_gc_keep(context, tmp_path):
+    context.storage = LocalStorage(str(tmp_path / "storage"))
+    other_step = Step.from_stage(context.job[0], job_id="other_job")
+    for step in (context.job[0], other_step):
+        context.storage.set_meta(f"{step.path}/data", "x" * 100)
+        context.storage.mark_done(step)
+    keep = tmp_path / "keep.json"
+    keep.write_text(json.dumps({"config": {"__id__": "other_job"}}))
+
+    args = ["-j", context.as_json(), "gc", "--budget", "0", "--keep", str(keep)]
+    result = CliRunner().invoke(app, args)
+    assert result.exit_code == 0
+    assert "deleted 0 results" in result.output
+
+
+def test_logs_running(context, tmp_path):
+    context.storage = storage = LocalStorage(str(tmp_path / "storage"))
+    workdir = tmp_path / "workdir"
+    workdir.mkdir()
+    (workdir / "__log__").write_text("stored\nlive\n")
+    storage.set_blob("test_job/__logs__/00001.log", b"stored\n")
+    storage.set_job_meta(
+        "test_job",
+        {
+            "__address__": str(workdir),
+            "__log_chunks__": json.dumps(["__logs__/00001.log"]),
+            "__step__": "test_step",
+        },
+    )
+
+    # the log of a running job is read from the executor
+    result = CliRunner().invoke(app, ["-j", context.as_json(), "logs"])
+    assert result.output == "stored\nlive\n"
+
+    storage.set_job_meta("test_job", {"__step__": ""})
+    result = CliRunner().invoke(app, ["-j", context.as_json(), "logs"])
+    assert result.output == "stored\n"
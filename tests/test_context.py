@@ -0,0 +1,73 @@
+from threading import Barrier
+import pytest
+
+from aeolos import AeolosContext
+
+
+@pytest.fixture
+def dag_context(context):
+    context.config["stages"] = [
+        {"id": "prepare", "command": "true"},
+        {"id": "left", "command": "true", "depends_on": ["prepare"]},
+        {"id": "right", "command": "true", "depends_on": ["prepare"]},
+        {"id": "merge", "command": "true", "depends_on": ["left", "right"]},
+    ]
+    return context
+
+
+def test_schedule_parallel(dag_context: AeolosContext):
+    order = []
+    barrier = Barrier(2, timeout=5)
+
+    def run(step):
+        if step.id in ("left", "right"):
+            barrier.wait()
+        order.append(step.id)
+
+    dag_context.schedule(dag_context.job, run, max_workers=2)
+    assert order[0] == "prepare"
+    assert set(order[1:3]) == {"left", "right"}
+    assert order[3] == "merge"
+
+
+def test_schedule_failure(dag_context: AeolosContext):
+    order = []
+
+    def run(step):
+        order.append(step.id)
+        if step.id == "left":
+            raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        dag_context.schedule(dag_context.job, run, max_workers=1)
+    assert "right" in order
+    assert "merge" not in order
+
+
+def test_plan(dag_context: AeolosContext):
+    job = dag_context.job
+    assert dag_context.plan(job, [True, True, True, True]) == {
+        "prepare": "skip",
+        "left": "skip",
+        "right": "skip",
+        "merge": "skip",
+    }
+    assert dag_context.plan(job, [True, True, False, False]) == {
+        "prepare": "pull",
+        "left": "pull",
+        "right": "run",
+        "merge": "run",
+    }
+
+
+def test_plan_shards(context: AeolosContext):
+    context.config["stages"] = [
+        {"id": "extract", "command": "true", "shards": 2},
+        {"id": "merge", "command": "true"},
+    ]
+    assert context.plan(context.job, [True, True, True, False]) == {
+        "extract__shard_0": "pull",
+        "extract__shard_1": "pull",
+        "extract": "run",
+        "merge": "run",
+    }
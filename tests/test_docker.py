@@ -1,4 +1,12 @@
-from aeolos.repository.docker import DockerRegistry
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Thread
+import os
+import pytest
+
+from aeolos.repository.docker import DockerImporter, DockerRegistry
 from aeolos import Step
 
 
@@ -14,3 +22,113 @@ def test_docker(executor):
     with executor.launch():
         with repository.in_executor(executor):
             repository.run(step)
+
+
+@pytest.fixture
+def docker_calls(tmp_path, monkeypatch) -> Path:
+    """
+    Replace docker with a script that records its calls.
+    Only images that were imported before are present.
+    """
+    calls = tmp_path / "calls"
+    calls.touch()
+    docker = tmp_path / "docker"
+    docker.write_text(
+        f'#!/bin/sh\n[ "$1" = image ] && grep -q " $3$" {calls} && exit 0\n'
+        f'echo "$@" >> {calls}\n[ "$1" = image ] && exit 1\nexit 0\n'
+    )
+    docker.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    return calls
+
+
+def test_docker_prefetch(executor, docker_calls):
+    repository = DockerRegistry(url="registry")
+    steps = [
+        Step(id=f"step_{i}", job_id="test_job", command=image, config={})
+        for i, image in enumerate(["first", "second", "first", "pinned@sha256:abc"])
+    ]
+
+    with executor.launch():
+        with repository.in_executor(executor):
+            repository.prefetch(steps)
+            for step in steps:
+                repository.run(step)
+
+    calls = docker_calls.read_text().splitlines()
+    pulls = sorted(call for call in calls if call.startswith("pull"))
+    assert pulls == [
+        "pull registry/first",
+        "pull registry/pinned@sha256:abc",
+        "pull registry/second",
+    ]
+    assert "image inspect registry/pinned@sha256:abc" in calls
+    assert calls[-1] == "run --rm registry/pinned@sha256:abc"
+
+
+def test_docker_import(executor, docker_calls, tmp_path):
+    (tmp_path / "image.tgz").write_bytes(b"image")
+    handler = partial(SimpleHTTPRequestHandler, directory=tmp_path)
+    server = ThreadingHTTPServer(("localhost", 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    url = f"http://localhost:{server.server_port}"
+    steps = [
+        Step(id=f"step_{i}", job_id="test_job", command=image, config={})
+        for i, image in enumerate(["image", "image", "missing"])
+    ]
+
+    try:
+        for _ in range(2):
+            repository = DockerImporter(url)
+            with executor.launch():
+                with repository.in_executor(executor):
+                    repository.prefetch(steps)
+                    for step in steps:
+                        repository.run(step)
+    finally:
+        server.shutdown()
+
+    image = repository.get_image_name(steps[0])
+    assert image.startswith("image:")
+    assert repository.get_image_name(steps[2]) == "missing"
+
+    calls = docker_calls.read_text().splitlines()
+    assert sorted(c for c in calls if c.startswith("import")) == [
+        f"import {url}/image.tgz {image}",
+        f"import {url}/missing.tgz missing",
+        f"import {url}/missing.tgz missing",
+    ]
+
+
+def test_docker_warm(executor, docker_calls):
+    repository = DockerRegistry(pull="missing", warm=True)
+    configs = [
+        {"command": "echo first", "env": {"KEY": "value"}},
+        {"command": "echo second"},
+        {"command": "echo isolated", "isolated": True},
+        {"command": "echo other", "docker_args": ["--network", "none"]},
+    ]
+    steps = [
+        Step(id=f"step_{i}", job_id="test_job", command="image", config=config)
+        for i, config in enumerate(configs)
+    ]
+
+    with executor.launch():
+        with repository.in_executor(executor):
+            # steps sharing a container while it starts wait for it
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                list(pool.map(repository.run, steps[:2]))
+            for step in steps[2:]:
+                repository.run(step)
+
+    calls = docker_calls.read_text().splitlines()
+    starts = [c for c in calls if c.startswith("run -d")]
+    assert len(starts) == 2
+    assert starts[1].endswith("--network none image -f /dev/null")
+
+    name = starts[0].split()[4]
+    assert f"exec -e KEY=value {name} echo first" in calls
+    assert f"exec {name} echo second" in calls
+    assert "run --rm image echo isolated" in calls
+    assert calls[-1].startswith(f"rm -f {name} ")
@@ -1,9 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from types import SimpleNamespace
 import pytest
+import time
 from moto import mock_ec2
 import boto3
 from uuid import uuid4
 
-from aeolos.executor.ec2 import EC2 as EC2Executor
+from aeolos.executor.ec2 import EC2 as EC2Executor, EC2Pool
+from aeolos.executor.ec2 import IDLE_SINCE_TAG, LEASE_TAG, STATE_TAG, get_tags
+from aeolos.executor.base import iter_lines
+from aeolos.executor.local import Local as LocalExecutor
+from aeolos.storage.local import Local as LocalStorage
+from aeolos.storage.logs import LogShipper, iter_stored_logs
+from aeolos import Step
 
 
 @pytest.fixture
@@ -24,8 +34,254 @@ def ec2_executor():
         )
 
 
-def test_ec2_executor(ec2_executor):
+class FakeConnection:
+    """A connection that records its commands and answers realpath"""
+
+    def __init__(self, host: str, connect_kwargs: dict):
+        self.host = host
+        self.connect_kwargs = connect_kwargs
+        self.commands: list[str] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def run(self, cmd: str, in_stream: bool = True):
+        self.commands.append(cmd)
+        return SimpleNamespace(stdout="/home/ubuntu/work\n")
+
+
+def test_ec2_executor(ec2_executor, monkeypatch):
+    monkeypatch.setattr("aeolos.executor.ssh.Connection", FakeConnection)
     with ec2_executor.setup() as address:
         assert address
-        with ec2_executor.connect(address):
-            assert ec2_executor.ssh
+        with ec2_executor.connect(address + "/work"):
+            ssh = ec2_executor.ssh
+            assert ssh.host == address
+            assert ssh.connect_kwargs == {"key_filename": "test_key.pem"}
+            assert ssh.commands == ["mkdir -p work && realpath work"]
+            assert ec2_executor.workdir == "/home/ubuntu/work"
+
+
+class LocalPool(EC2Pool):
+    """A pool of local executors, with their workdirs as addresses"""
+
+    def get_member(self, address: str) -> LocalExecutor:
+        return LocalExecutor()
+
+
+@pytest.fixture
+def security_group():
+    with mock_ec2():
+        client = boto3.client("ec2", region_name="us-east-1")
+        response = client.create_security_group(
+            Description="test", GroupName=str(uuid4())[0:6]
+        )
+        yield response["GroupId"]
+
+
+def test_ec2_pool(security_group):
+    pool = EC2Pool(
+        ami_id="ami-1234",
+        instance_type="g4dn.test",
+        key_name="test_key",
+        key_file="test_key.pem",
+        security_group=security_group,
+        count=3,
+        region="us-east-1",
+        ssh_timeout=None,
+    )
+    ec2 = pool.get_ec2()
+
+    with pool.setup() as address:
+        addresses = address.split(",")
+        assert len(addresses) == 3
+        assert all(a.startswith("ubuntu@") for a in addresses)
+
+        instances = list(ec2.instances.all())
+        assert len(instances) == 3
+        assert all(i.state["Name"] == "running" for i in instances)
+
+    assert all(i.state["Name"] == "terminated" for i in ec2.instances.all())
+
+
+def test_ec2_pool_terminates_on_error(security_group):
+    pool = EC2Pool(
+        ami_id="ami-1234",
+        instance_type="g4dn.test",
+        key_name="test_key",
+        key_file="test_key.pem",
+        security_group=security_group,
+        count=2,
+        region="us-east-1",
+        ssh_timeout=0,
+    )
+
+    with pytest.raises(TimeoutError):
+        with pool.setup():
+            pass
+
+    instances = list(pool.get_ec2().instances.all())
+    assert len(instances) == 2
+    assert all(i.state["Name"] == "terminated" for i in instances)
+
+
+def test_ec2_pool_placement(tmp_path):
+    pool = LocalPool("ami", "type", "key", "key.pem", "group", count=2)
+    workdirs = [tmp_path / "first", tmp_path / "second"]
+    for workdir in workdirs:
+        workdir.mkdir()
+
+    steps = {
+        name: Step(id=name, job_id="job", command="true", config={})
+        for name in ("prepare", "left", "right", "merge")
+    }
+    placed = {}
+
+    def run(name: str, inputs: list[str]):
+        step = steps[name]
+        with pool.place(step, [steps[i] for i in inputs], pull) as pulled:
+            placed[name] = (pool.host, [s.name for s in pulled])
+            pool.command(["sh", "-c", f"echo {name} | tee out"], step=step)
+
+    def pull(step: Step):
+        pool.command(["touch", f"pulled_{step.id}"])
+
+    with pool.connect(",".join(map(str, workdirs))):
+        pool.command(["touch", "shared"])
+        run("prepare", [])
+
+        # independent steps run on different instances
+        with pool.place(steps["left"], [steps["prepare"]], pull) as pulled:
+            placed["left"] = (pool.host, [s.name for s in pulled])
+            thread = Thread(target=run, args=("right", ["prepare"]))
+            thread.start()
+            thread.join()
+            pool.command(["touch", "out"], step=steps["left"])
+
+        run("merge", ["left", "right"])
+        assert pool.read_step_logs("job/right") == b"right\n"
+
+    assert placed == {
+        "prepare": ("0", []),
+        "left": ("0", []),
+        "right": ("1", ["prepare"]),
+        "merge": ("0", ["right"]),
+    }
+    assert (workdirs[0] / "shared").exists() and (workdirs[1] / "shared").exists()
+    assert (workdirs[1] / "job/right/out").read_text() == "right\n"
+    assert (workdirs[1] / "pulled_prepare").exists()
+    assert (workdirs[0] / "job/merge/out").exists()
+
+
+def test_ec2_pool_pulls(tmp_path):
+    pool = LocalPool("ami", "type", "key", "key.pem", "group", count=1)
+    steps = [
+        Step(id=name, job_id="job", command="true", config={})
+        for name in ("input", "first", "second")
+    ]
+    pulling, pulls = Event(), []
+
+    def pull(step: Step):
+        pulls.append(step.name)
+        pulling.set()
+        time.sleep(0.1)
+
+    def run(step: Step) -> list[str]:
+        with pool.place(step, steps[:1], pull) as pulled:
+            assert "input" in pulls
+            return [s.name for s in pulled]
+
+    with pool.connect(str(tmp_path)):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(run, steps[1])
+            pulling.wait()
+            # the second step waits for the pull of the first one
+            second = executor.submit(run, steps[2])
+            assert (first.result(), second.result()) == (["input"], [])
+    assert pulls == ["input"]
+
+
+def test_ec2_idle_pool(security_group, monkeypatch):
+    def launch(instance_type="g4dn.test"):
+        executor = EC2Executor(
+            ami_id="ami-1234",
+            instance_type=instance_type,
+            key_name="test_key",
+            key_file="test_key.pem",
+            security_group=security_group,
+            region="us-east-1",
+            idle_ttl=600,
+            lease_delay=0,
+        )
+        with executor.setup() as address:
+            return executor, address
+
+    executor, first = launch()
+    _, second = launch()
+    _, other = launch(instance_type="other.test")
+
+    # the second launch reuses the instance in its own workdir
+    assert first.split("/")[0] == second.split("/")[0]
+    assert first != second
+    assert other.split("/")[0] != first.split("/")[0]
+
+    ec2 = executor.get_ec2()
+    instances = list(ec2.instances.all())
+    assert len(instances) == 2
+    assert all(get_tags(i)[STATE_TAG] == "idle" for i in instances)
+    assert all(LEASE_TAG not in get_tags(i) for i in instances)
+
+    # an instance leased since it was listed is not leased again
+    leased = next(i for i in instances if i.instance_type == "g4dn.test")
+    listed = executor.get_idle_instances(ec2)
+    leased.create_tags(Tags=[{"Key": LEASE_TAG, "Value": "other"}])
+    monkeypatch.setattr(executor, "get_idle_instances", lambda *args: listed)
+    assert executor.lease(ec2, "token") is None
+    leased.reload()
+    assert get_tags(leased)[LEASE_TAG] == "other"
+    monkeypatch.undo()
+    leased.delete_tags(Tags=[{"Key": LEASE_TAG}])
+
+    assert executor.sweep() == []
+    instances[0].create_tags(Tags=[{"Key": IDLE_SINCE_TAG, "Value": "0"}])
+    assert executor.sweep() == [instances[0].id]
+
+    # a failed launch terminates the instance
+    with pytest.raises(RuntimeError):
+        with executor.setup():
+            raise RuntimeError()
+    states = [i.state["Name"] for i in ec2.instances.all()]
+    assert states.count("terminated") == 2
+
+
+def test_ec2_idle_workdir(ec2_executor, monkeypatch):
+    monkeypatch.setattr("aeolos.executor.ssh.Connection", FakeConnection)
+    ec2_executor.idle_ttl = 600
+    with ec2_executor.connect("ubuntu@host/work"):
+        ssh = ec2_executor.ssh
+        ec2_executor._launch_channel = SimpleNamespace(close=lambda: None)
+    assert ssh.commands[-1] == "rm -rf /home/ubuntu/work"
+
+
+def test_ec2_pool_logs(tmp_path):
+    pool = LocalPool("ami", "type", "key", "key.pem", "group", count=2)
+    workdirs = [tmp_path / "first", tmp_path / "second"]
+    for workdir in workdirs:
+        workdir.mkdir()
+    storage = LocalStorage(str(tmp_path / "storage"))
+
+    with pool.connect(",".join(map(str, workdirs))):
+        pool.command(["echo", "both"])
+        step = Step(id="step", job_id="job", command="true", config={})
+        with pool.place(step, [], None):
+            pool.command(["echo", "placed"])
+
+        assert list(pool.iter_logs()) == ["both", "placed", "both"]
+        assert list(pool.iter_logs(offset=12)) == ["both"]
+
+        LogShipper(storage, pool, "job").flush(final=True)
+        stored = iter_lines(iter_stored_logs(storage, "job"))
+        assert sorted(stored) == ["both", "both", "placed"]
@@ -1,14 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 import pytest
 import os
+import shutil
 import json
-from subprocess import Popen, run
+from subprocess import CalledProcessError, Popen, run
 import time
 
 from aeolos.executor.local import Local as LocalExecutor
 from aeolos.repository.local import Local as LocalRepository
 from aeolos.storage.local import Local as LocalStorage
+from aeolos.storage.tiered import Tiered as TieredStorage
 from aeolos.context import AeolosContext
+from aeolos.executor.base import iter_lines
+from aeolos.storage.logs import LogShipper, iter_stored_logs
+from aeolos import Step
 
 AEOLOS_CMD = ["poetry", "run", "aeolos"]
 
@@ -136,3 +142,316 @@ def test_terminate(long_running_context):
 
     run(AEOLOS_CMD + ["-j", config, "terminate"], capture_output=True, check=True)
     assert proc.poll() is not None
+
+
+def test_meta_many(context: AeolosContext):
+    storage = context.storage
+    steps = list(context.job)
+    assert storage.is_done_many(steps) == [False]
+
+    storage.set_meta_many({"test_job/a": "1", "test_job/b/c": "2"})
+    assert storage.get_meta_many(["test_job/a", "test_job/b/c", "test_job/d"]) == {
+        "test_job/a": "1",
+        "test_job/b/c": "2",
+    }
+
+    storage.mark_done(steps[0])
+    assert storage.is_done_many(steps) == [True]
+
+
+def test_manifest(context: AeolosContext):
+    storage = context.storage
+    storage.manifest = True
+    steps = list(context.job)
+
+    storage.set_job_meta("test_job", {"__address__": "localhost"})
+    storage.mark_done(steps[0])
+    assert storage.is_done_many(steps) == [True]
+    assert set(os.listdir(storage.basepath / "test_job")) == {
+        "__manifest__.json",
+        "__manifest__.lock",
+    }
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        pool.map(lambda i: storage.set_job_meta("test_job", {str(i): ""}), range(32))
+
+    manifest, _ = storage.read_manifest("test_job")
+    assert manifest["version"] == 34
+    assert storage.get_job_meta("test_job", ["__address__", "0", "31"]) == {
+        "__address__": "localhost",
+        "0": "",
+        "31": "",
+    }
+
+
+def test_content_addressed(context: AeolosContext):
+    storage = context.storage
+    storage.content_addressed = True
+    step = context.job[0]
+    other_step = Step.from_stage(step, job_id="other_job")
+
+    assert storage.get_location(step) == storage.get_location(other_step)
+    assert storage.get_location(step).startswith("__objects__/")
+
+    storage.mark_done(step)
+    assert storage.is_done_many([step, other_step]) == [True, True]
+
+    other_step.config = {"file": "other"}
+    assert not storage.is_done(other_step)
+
+
+def test_pack(context: AeolosContext):
+    executor = context.executor
+    storage = context.storage
+    storage.pack = "gzip"
+    step = context.job[0]
+
+    with context.launch():
+        executor.command(step.format_command(), step=step)
+        storage.store(step)
+        assert set(os.listdir(storage.basepath / "test_job" / "test_step")) == {
+            "__pack__",
+            "__done__",
+        }
+
+    with context.launch():
+        storage.pull(step)
+        assert os.listdir(executor.workdir / "test_job" / "test_step") == ["test"]
+
+
+@pytest.mark.parametrize("link_mode", ["hardlink", "auto"])
+def test_link_mode(context: AeolosContext, link_mode):
+    executor = context.executor
+    storage = context.storage
+    storage.link_mode = link_mode
+    step = context.job[0]
+
+    with context.launch():
+        executor.command(step.format_command(), step=step)
+        storage.store(step)
+        stored = storage.basepath / "test_job" / "test_step" / "test"
+        assert not stored.samefile(executor.workdir / "test_job" / "test_step" / "test")
+
+    with context.launch():
+        storage.pull(step)
+        pulled = executor.workdir / "test_job" / "test_step" / "test"
+        assert os.listdir(pulled.parent) == ["test"]
+        assert not pulled.samefile(stored)
+
+
+def test_tiered(context: AeolosContext):
+    executor = context.executor
+    step = context.job[0]
+    with TemporaryDirectory() as cache_path:
+        storage = TieredStorage(
+            {"__class__": "aeolos.storage.local.Local", "link_mode": "hardlink"}
+            | {"basepath": context.storage.basepath.as_posix()},
+            cache_path=cache_path,
+            cache_size=0,
+        )
+        context.storage = storage
+
+        with context.launch():
+            executor.command(["sh", "-c", "echo cached > test"], step=step)
+            storage.store(step)
+            assert storage.is_done(step)
+            assert os.listdir(cache_path) == []
+
+        storage.cache_size = 1024
+        with context.launch():
+            storage.pull(step)
+            assert os.listdir(cache_path) == [step.sha256()]
+
+        # cache hits count as accesses of the wrapped storage
+        stored = storage._storage.basepath / "test_job" / "test_step"
+        os.utime(stored, (0, 0))
+        with context.launch():
+            storage.pull(step)
+        assert stored.stat().st_mtime > 0
+
+        shutil.rmtree(stored)
+        with context.launch():
+            storage.pull(step)
+            assert os.listdir(executor.workdir / "test_job" / "test_step") == ["test"]
+
+        # garbage collection drops the manifest entries of the wrapped storage
+        storage._storage.manifest = True
+        old_step = Step.from_stage(step, job_id="old_job")
+        storage.set_meta(f"{old_step.path}/data", "x")
+        storage.mark_done(old_step)
+        assert storage.manifest and storage.is_done(old_step)
+        storage.collect_garbage([step], budget=0)
+        assert not storage.is_done(old_step)
+
+
+def test_gc(context: AeolosContext):
+    storage = context.storage
+    storage.manifest = True
+    step = context.job[0]
+    old_step = Step.from_stage(step, job_id="old_job")
+    for s in (step, old_step):
+        storage.set_meta(f"{s.path}/data", "x" * 100)
+        storage.mark_done(s)
+    storage.set_meta("old_job/__logs__", "logs")
+    os.utime(storage.basepath / "old_job" / "__logs__", (0, 0))
+
+    results = {r["location"]: r for r in storage.list_results()}
+    assert set(results) == {
+        "test_job/test_step",
+        "old_job/test_step",
+        "old_job/__logs__",
+    }
+    assert results["old_job/test_step"]["size"] == 100
+    assert results["old_job/__logs__"]["last_access"] == 0
+
+    deleted = storage.collect_garbage([step], max_age=3600)
+    assert [r["location"] for r in deleted] == ["old_job/__logs__"]
+
+    deleted = storage.collect_garbage([step], budget=150, dry_run=True)
+    assert [r["location"] for r in deleted] == ["old_job/test_step"]
+    assert storage.is_done(old_step)
+
+    storage.collect_garbage([step], budget=150)
+    assert storage.is_done_many([step, old_step]) == [True, False]
+    assert not (storage.basepath / "old_job" / "test_step").exists()
+
+    # results of a job that is still running are kept
+    running_step = Step.from_stage(step, job_id="running_job")
+    storage.set_meta(f"{running_step.path}/data", "x" * 100)
+    storage.mark_done(running_step)
+    storage.set_job_meta("running_job", {"__step__": "test_step"})
+    deleted = storage.collect_garbage([], budget=0)
+    assert {r["location"] for r in deleted} == {"test_job/test_step"}
+    assert storage.is_done(running_step)
+
+
+def test_sqlite(executor, repository, config):
+    with TemporaryDirectory() as basepath:
+        storage = LocalStorage(basepath, sqlite=True)
+        context = AeolosContext(config, executor, storage, repository)
+        step = context.job[0]
+
+        storage.mark_done(step)
+        assert storage.is_done(step)
+        assert storage.get_meta_many(["test_job/__step__", f"{step.path}/__done__"])
+        with pytest.raises(KeyError):
+            storage.get_meta("test_job/__step__")
+        assert not (storage.basepath / "test_job").exists()
+
+        storage.set_job_state("test_job", "running")
+        storage.set_step_state(step, "running")
+        storage.set_job_state("other_job", "done")
+        jobs = storage.list_jobs(state="running")
+        assert [(j["id"], j["steps"], j["done"]) for j in jobs] == [("test_job", 1, 0)]
+
+        storage.set_step_state(step, "done", duration=1.0)
+        storage.set_job_state("test_job", "done")
+        assert {j["id"] for j in storage.list_jobs(since=time.time() - 60)} == {
+            "test_job",
+            "other_job",
+        }
+        assert storage.list_jobs(state="done")[0]["done"] == 1
+
+        storage._index.set_many({"old_job/ablogs__": "x"})
+        logs = storage._index.list_meta("/__logs__")
+        assert logs == []
+
+        storage.set_meta("old_job/__logs__", "logs")
+        deleted = storage.collect_garbage([step], budget=0)
+        assert [r["location"] for r in deleted] == ["old_job/__logs__"]
+        assert storage.get_meta_many(["old_job/__logs__"]) == {}
+
+
+def test_pull_marked_done(executor, repository, config):
+    with TemporaryDirectory() as basepath:
+        storage = LocalStorage(basepath, content_addressed=True, sqlite=True)
+        context = AeolosContext(config, executor, storage, repository)
+        step = context.job[0]
+
+        storage.mark_done(step)
+        with context.launch():
+            storage.pull(step)
+        assert not (storage.basepath / storage.get_location(step)).exists()
+
+
+def test_follow_logs(executor: LocalExecutor):
+    with executor.launch():
+        executor.command(["echo", "first"])
+        offset = executor.log_file_path.stat().st_size
+        assert list(executor.iter_logs(offset=offset)) == []
+
+        # follow until a process writing to the log exits
+        script = "for i in 1 2 3; do echo line_$i; sleep 0.1; done"
+        with executor.log_file_path.open("a") as log_file:
+            proc = Popen(["sh", "-c", script], stdout=log_file)
+        (executor.workdir / "__pid__").write_text(str(proc.pid))
+
+        logs = list(executor.iter_logs(follow=True, offset=offset))
+        proc.wait()
+        assert logs == ["line_1", "line_2", "line_3"]
+
+
+def test_ship_logs(executor: LocalExecutor, storage: LocalStorage):
+    with executor.launch():
+        shipper = LogShipper(
+            storage, executor, "test_job", interval=0.05, chunk_size=16
+        )
+        with shipper.ship():
+            # lines are buffered until a chunk is full
+            executor.command(["echo", "first line"])
+            time.sleep(0.2)
+            assert storage.get_job_meta("test_job", ["__log_chunks__"]) == {}
+
+            # full chunks are shipped while the job runs
+            executor.command(["echo", "a line longer than a chunk"])
+            time.sleep(0.2)
+            assert len(json.loads(storage.get_meta("test_job/__log_chunks__"))) == 2
+            with executor.log_file_path.open("a") as log_file:
+                log_file.write("incomplete")
+
+        logs = b"".join(iter_stored_logs(storage, "test_job"))
+        assert logs == executor.read_logs()
+        assert len(json.loads(storage.get_meta("test_job/__log_chunks__"))) == 4
+
+        logs = iter_lines(iter_stored_logs(storage, "test_job", offset=11))
+        assert list(logs) == ["a line longer than a chunk", "incomplete"]
+
+
+def test_step_logs(executor: LocalExecutor):
+    step = Step(id="test_step", job_id="test_job", command="", config={})
+    other_step = Step.from_stage(step, id="other_step")
+    with executor.launch():
+        executor.command(["echo", "first"], step=step)
+        executor.command(["echo", "other"], step=other_step)
+        with pytest.raises(CalledProcessError):
+            executor.command(["sh", "-c", "echo second >&2; exit 1"], step=step)
+
+        assert executor.read_step_logs(step.path) == b"first\nsecond\n"
+        assert executor.read_step_logs(other_step.path) == b"other\n"
+        assert executor.read_logs() == b"first\nother\nsecond\n"
+
+        entries = executor.get_log_index()
+        assert [(e["step"], e["offset"], e["length"]) for e in entries] == [
+            (step.path, 0, 6),
+            (other_step.path, 0, 6),
+            (step.path, 6, 7),
+        ]
+
+
+def test_batch(executor: LocalExecutor, storage: LocalStorage):
+    step = Step(id="test_step", job_id="test_job", command="", config={})
+    with executor.launch(), storage.in_executor(executor):
+        with executor.batch() as results:
+            storage.command(["touch", "test"], step=step)
+            with executor.batch():
+                storage.command(["touch", "nested"], step=step)
+            assert os.listdir(executor.get_local_path(step)) == []
+        assert [r["returncode"] for r in results] == [0, 0]
+        assert set(os.listdir(executor.get_local_path(step))) == {"test", "nested"}
+
+        with pytest.raises(CalledProcessError):
+            with executor.batch() as results:
+                storage.command(["false"], step=step)
+                storage.command(["touch", "after"], step=step)
+        assert [r["returncode"] for r in results] == [1]
+        assert "after" not in os.listdir(executor.get_local_path(step))
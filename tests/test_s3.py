@@ -1,13 +1,18 @@
+import json
+import os
 import pytest
 from moto.server import ThreadedMotoServer
 import boto3
 
 from aeolos.storage.s3 import S3 as S3Storage
+from aeolos.storage.transfer import MB
 from aeolos import Step
 
 
 @pytest.fixture
-def s3_storage():
+def s3_storage(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
     endpoint = "http://localhost:5000"
     bucket_name = "test_bucket"
 
@@ -33,3 +38,161 @@ def test_s3_storage(executor, s3_storage):
 
             executor.command("rm -rf test_job")
             s3_storage.pull(step)
+            assert (executor.workdir / "test_job" / "test_step" / "test").exists()
+
+
+def test_s3_multipart(executor, s3_storage):
+    step = Step(id="test_step", job_id="test_job", command="", config={})
+    s3_storage.multipart_threshold = s3_storage.multipart_chunksize = 5 * MB
+    with executor.launch():
+        with s3_storage.in_executor(executor):
+            data = os.urandom(12 * MB)
+            (executor.get_local_path(step) / "data").write_bytes(data)
+            s3_storage.push(step)
+
+            executor.command("rm -rf test_job")
+            s3_storage.pull(step)
+            assert (executor.get_local_path(step) / "data").read_bytes() == data
+
+
+def test_s3_meta_many(s3_storage):
+    s3_storage.set_meta_many({f"test_job/key_{i}": str(i) for i in range(10)})
+    keys = [f"test_job/key_{i}" for i in range(12)]
+    assert s3_storage.get_meta_many(keys) == {
+        f"test_job/key_{i}": str(i) for i in range(10)
+    }
+    assert s3_storage.get_client() is s3_storage.get_client()
+
+
+def test_s3_manifest(s3_storage):
+    s3_storage.manifest = True
+    s3_storage.set_job_meta("test_job", {"__address__": "localhost"})
+    s3_storage.set_job_meta("test_job", {"__step__": "test_step"})
+    assert s3_storage.get_job_meta("test_job", ["__address__", "__step__"]) == {
+        "__address__": "localhost",
+        "__step__": "test_step",
+    }
+
+    manifest, version = s3_storage.read_manifest("test_job")
+    assert manifest["version"] == 2
+    assert version
+
+
+def test_s3_outputs(executor, s3_storage):
+    step = Step(
+        id="test_step",
+        job_id="test_job",
+        command="",
+        config={},
+        outputs=["results", "**/*.txt"],
+        exclude=["results/cache"],
+    )
+    with executor.launch():
+        with s3_storage.in_executor(executor):
+            workdir = executor.get_local_path(step)
+            for name in [
+                "a.txt",
+                "b.bin",
+                "sub/c.txt",
+                "results/model.pt",
+                "results/cache/tmp",
+            ]:
+                (workdir / name).parent.mkdir(parents=True, exist_ok=True)
+                (workdir / name).write_text(name)
+
+            s3_storage.push(step)
+            files = json.loads(s3_storage.get_meta("test_job/test_step/__files__"))
+            assert files == ["a.txt", "results/model.pt", "sub/c.txt"]
+
+            executor.command("rm -rf test_job")
+            s3_storage.pull(step)
+            pulled = {
+                p.relative_to(workdir).as_posix()
+                for p in workdir.rglob("*")
+                if p.is_file()
+            }
+            assert pulled == set(files)
+
+
+def test_s3_pack(executor, s3_storage):
+    step = Step(id="test_step", job_id="pack_job", command="", config={})
+    s3_storage.pack = "gzip"
+    s3_storage.pack_chunk_size = 64 * 1024
+    with executor.launch():
+        with s3_storage.in_executor(executor):
+            workdir = executor.get_local_path(step)
+            data = {f"file_{i}": os.urandom(1024) for i in range(100)}
+            for name, content in data.items():
+                (workdir / name).write_bytes(content)
+
+            s3_storage.push(step)
+            client = s3_storage.get_client()
+            response = client.list_objects_v2(
+                Bucket=s3_storage.bucket, Prefix="pack_job/"
+            )
+            keys = [obj["Key"] for obj in response["Contents"]]
+            assert len(keys) == 2
+            assert all(key.endswith(".tar.gz") for key in keys)
+
+            executor.command("rm -rf pack_job")
+            s3_storage.pull(step)
+            for name, content in data.items():
+                assert (workdir / name).read_bytes() == content
+
+
+def test_s3_delta(executor, s3_storage, capsys):
+    step = Step(id="test_step", job_id="delta_job", command="", config={})
+    s3_storage.delta = True
+    with executor.launch():
+        with s3_storage.in_executor(executor):
+            workdir = executor.get_local_path(step)
+            for name in ["a", "b", "c"]:
+                (workdir / name).write_text(name)
+            s3_storage.push(step)
+
+            (workdir / "a").write_text("changed")
+            (workdir / "c").unlink()
+            capsys.readouterr()
+            s3_storage.push(step)
+            assert "[push] delta_job/test_step: 1 files" in capsys.readouterr().out
+
+            client = s3_storage.get_client()
+            response = client.list_objects_v2(
+                Bucket=s3_storage.bucket, Prefix="delta_job/"
+            )
+            keys = {obj["Key"] for obj in response["Contents"]}
+            assert keys == {
+                "delta_job/test_step/a",
+                "delta_job/test_step/b",
+                "delta_job/test_step/__index__.json",
+            }
+
+            (workdir / "b").write_text("local")
+            s3_storage.pull(step)
+            assert "[pull] delta_job/test_step: 1 files" in capsys.readouterr().out
+            assert (workdir / "b").read_text() == "b"
+
+
+def test_s3_gc(s3_storage):
+    step = Step(id="test_step", job_id="gc_job", command="", config={})
+    old_step = Step.from_stage(step, job_id="gc_old_job")
+    for s in (step, old_step):
+        s3_storage.set_meta(f"{s.path}/data", "x" * 100)
+        s3_storage.mark_done(s)
+    s3_storage.set_meta("gc_old_job/__logs__", "logs")
+
+    results = {r["location"]: r for r in s3_storage.list_results()}
+    assert results["gc_old_job/test_step"]["size"] == 100 + len(step.sha256())
+    assert "gc_old_job/__logs__" in results
+    assert "gc_old_job/__address__" not in results
+
+    deleted = s3_storage.collect_garbage([step], budget=0, dry_run=True)
+    locations = {r["location"] for r in deleted}
+    assert {"gc_old_job/test_step", "gc_old_job/__logs__"} <= locations
+    assert "gc_job/test_step" not in locations
+    assert s3_storage.is_done(old_step)
+
+    s3_storage.collect_garbage([step], budget=0)
+    assert s3_storage.is_done_many([step, old_step]) == [True, False]
+    locations = {r["location"] for r in s3_storage.list_results()}
+    assert "gc_old_job/test_step" not in locations
@@ -1,8 +1,15 @@
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen, run
+from types import SimpleNamespace
 import docker
+import os
 import pytest
 import time
 
 from aeolos.executor.ec2 import SSH as SSHExecutor
+from aeolos.executor.executing import Executing
+from aeolos.executor.shell import ShellSession
+from aeolos.storage.local import Local as LocalStorage
+from aeolos import Step
 
 
 @pytest.fixture
@@ -39,3 +46,160 @@ def test_ssh_executor(ssh_executor):
         ssh_executor.command('echo "hello\nworld"')
         logs = list(ssh_executor.iter_logs())
         assert logs == ["hello", "world"]
+
+
+class LocalChannel:
+    """A channel running its command in a local process"""
+
+    def __init__(self):
+        self.closed = False
+        self._proc = None
+
+    def set_combined_stderr(self, combined: bool):
+        pass
+
+    def exec_command(self, cmd: str):
+        self._proc = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+
+    def sendall(self, data: bytes):
+        self._proc.stdin.write(data)
+        self._proc.stdin.flush()
+
+    def recv(self, size: int) -> bytes:
+        return self._proc.stdout.read1(size)
+
+    def close(self):
+        self.closed = True
+        self._proc.stdin.close()
+        self._proc.wait()
+
+
+class LocalTransport:
+    def open_session(self) -> LocalChannel:
+        return LocalChannel()
+
+
+def test_shell_session():
+    session = ShellSession(LocalTransport())
+    try:
+        futures = [session.submit(f"echo {i}; sleep 0.1") for i in range(3)]
+        futures.append(session.submit("echo failed >&2; exit 3"))
+        futures.append(session.submit("cd / && export VAR=value"))
+
+        assert [future.result() for future in futures[:3]] == ["0\n", "1\n", "2\n"]
+        with pytest.raises(CalledProcessError) as e:
+            futures[3].result()
+        assert (e.value.returncode, e.value.output) == (3, "failed\n")
+
+        # commands run in subshells that do not change the session
+        assert session.run("pwd; echo ${VAR:-unset}") == f"{os.getcwd()}\nunset\n"
+        assert session.run("cat") == ""
+    finally:
+        session.close()
+    assert not session.active
+
+
+def test_ssh_sessions(tmp_path):
+    executor = SSHExecutor(sessions=2)
+    executor._connection = SimpleNamespace(
+        client=SimpleNamespace(get_transport=LocalTransport)
+    )
+    executor._workdir = str(tmp_path)
+    step = Step(id="test_step", job_id="test_job", command="", config={})
+
+    try:
+        executor.command("echo first", env={"VAR": "a b"})
+        with executor.pipeline() as submit:
+            submit('echo "$VAR"', env={"VAR": "a b"}, step=step)
+            submit(["touch", "test"], step=step)
+        with pytest.raises(CalledProcessError):
+            with executor.pipeline() as submit:
+                submit("exit 1", step=step)
+                submit("echo after", step=step)
+
+        assert (tmp_path / "test_job" / "test_step" / "test").exists()
+        assert (tmp_path / "__log__").read_text() == "first\na b\nafter\n"
+        assert executor.read_step_logs(step.path) == b"a b\nafter\n"
+        assert len(executor._sessions) == 1
+    finally:
+        executor.close_sessions()
+
+
+def test_ssh_batch(tmp_path):
+    executor = SSHExecutor()
+    executor._connection = SimpleNamespace(
+        client=SimpleNamespace(get_transport=LocalTransport)
+    )
+    executor._workdir = str(tmp_path)
+    step = Step(id="test_step", job_id="test_job", command="", config={})
+    command = Executing()
+    command._executor = executor
+
+    try:
+        with executor.batch() as results:
+            command.command(["echo", "first"], step=step)
+            command.command("touch test", step=step)
+            assert results == []
+        assert [r["returncode"] for r in results] == [0, 0]
+        assert all(r["start"] <= r["end"] for r in results)
+        assert (tmp_path / "test_job" / "test_step" / "test").exists()
+
+        with pytest.raises(CalledProcessError) as e:
+            with executor.batch() as results:
+                command.command("echo failed >&2; exit 2")
+                command.command("touch after", step=step)
+        assert e.value.output == "failed"
+        assert [r["returncode"] for r in results] == [2]
+        assert not (tmp_path / "test_job" / "test_step" / "after").exists()
+    finally:
+        executor.close_sessions()
+
+
+def test_ssh_follow_logs(tmp_path):
+    executor = SSHExecutor()
+    executor._connection = SimpleNamespace(
+        client=SimpleNamespace(get_transport=LocalTransport),
+        run=lambda cmd, in_stream: run(cmd, shell=True, check=True),
+    )
+    executor._workdir = str(tmp_path)
+    (tmp_path / "__log__").write_bytes(b"first\r\n\xff\n")
+
+    try:
+        executor.start()
+        pidfile = tmp_path / "__pid__"
+        while not pidfile.exists() or not pidfile.read_text():
+            time.sleep(0.01)
+        chunks = executor.iter_log_chunks(follow=True, offset=7)
+        assert next(chunks) == b"\xff\n"
+
+        # following ends with the launch
+        executor.stop()
+        assert b"".join(chunks) == b""
+        assert not pidfile.exists()
+    finally:
+        executor.close_sessions()
+
+
+def test_ssh_transfer(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    executor = SSHExecutor()
+    executor._connection = SimpleNamespace(
+        client=SimpleNamespace(get_transport=LocalTransport)
+    )
+    executor._workdir = str(tmp_path / "workdir")
+    storage = LocalStorage(
+        str(tmp_path / "storage"), content_addressed=True, pack="gzip"
+    )
+    storage._executor = executor
+    step = Step(id="test_step", job_id="test_job", command="", config={})
+
+    try:
+        executor.command(["sh", "-c", "echo result > test"], step=step)
+        storage.push(step)
+        storage.pull(Step.from_stage(step, job_id="other_job"))
+    finally:
+        executor.close_sessions()
+
+    assert len(list((tmp_path / "home/.cache/aeolos").iterdir())) == 1
+    pulled = tmp_path / "workdir/other_job/test_step/test"
+    assert pulled.read_text() == "result\n"
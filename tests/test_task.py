@@ -0,0 +1,99 @@
+import pytest
+
+from aeolos import Stage, Task, Job
+
+
+def test_sequential_dependencies():
+    task = Task([Stage("a", "true"), Stage("b", "true"), Stage("c", "true")])
+    assert [task.dependencies(stage) for stage in task] == [[], ["a"], ["b"]]
+
+
+def test_declared_dependencies():
+    stages = [
+        Stage("prepare", "true"),
+        Stage("left", "true", depends_on=["prepare"]),
+        Stage("right", "true", depends_on=["prepare"]),
+        Stage("merge", "true", depends_on=["left", "right"]),
+    ]
+    job = Job(stages=stages, id="job", config={})
+    assert {step.id: step.depends_on for step in job} == {
+        "prepare": [],
+        "left": ["prepare"],
+        "right": ["prepare"],
+        "merge": ["left", "right"],
+    }
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError, match="unknown"):
+        Task([Stage("a", "true", depends_on=["b"])])
+
+
+def test_cyclic_dependency():
+    with pytest.raises(ValueError, match="Cyclic"):
+        Task(
+            [
+                Stage("a", "true", depends_on=["b"]),
+                Stage("b", "true", depends_on=["a"]),
+            ]
+        )
+
+
+def test_shards():
+    stages = [
+        Stage("prepare", "true"),
+        Stage("extract", "extract {part}", shards=[{"part": "a"}, {"part": "b"}]),
+        Stage("merge", "true"),
+    ]
+    job = Job(stages=stages, id="job", config={"extract": {"level": 1}})
+    steps = {step.name: step for step in job}
+    assert list(steps) == [
+        "prepare",
+        "extract__shard_0",
+        "extract__shard_1",
+        "extract",
+        "merge",
+    ]
+
+    shard = steps["extract__shard_1"]
+    assert shard.path == "job/extract__shard_1"
+    assert shard.depends_on == ["prepare"]
+    assert shard.format_command() == "extract b"
+    assert shard.config == {"level": 1, "shard": 1, "num_shards": 2, "part": "b"}
+
+    gather = steps["extract"]
+    assert gather.path == "job/extract"
+    assert gather.command == ""
+    assert gather.depends_on == ["extract__shard_0", "extract__shard_1"]
+    assert steps["merge"].depends_on == ["extract"]
+    assert len({step.sha256() for step in steps.values()}) == len(steps)
+
+
+def test_upstream_fingerprints():
+    stages = [
+        Stage("a", "true"),
+        Stage("b", "true"),
+        Stage("c", "true", depends_on=["a"]),
+    ]
+    job = Job(stages=stages, id="job", config={"a": {"x": {"y": 1, "z": 2}}})
+    changed = Job(stages=stages, id="other", config={"a": {"x": {"z": 2, "y": 2}}})
+    reordered = Job(stages=stages, id="other", config={"a": {"x": {"z": 2, "y": 1}}})
+
+    fingerprints = [step.sha256() for step in job]
+    assert fingerprints == [step.sha256() for step in reordered]
+    assert all(a != b for a, b in zip(fingerprints, (s.sha256() for s in changed)))
+
+
+def test_input_fingerprints(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data.txt").write_text("1")
+    stages = [Stage("a", "true", inputs=["*.txt"]), Stage("b", "true")]
+
+    fingerprints = [step.sha256() for step in Job(stages, "job", {})]
+    (tmp_path / "data.txt").write_text("2")
+    assert all(
+        a != b
+        for a, b in zip(
+            fingerprints, (step.sha256() for step in Job(stages, "job", {}))
+        )
+    )